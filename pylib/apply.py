@@ -2,24 +2,65 @@
 
 # Apply a delta
 
-import sys, argparse, csv
-from util import windex, correspondence, apply_correspondence
+import sys, os, io, argparse, csv, shutil, tempfile
+from util import windex, correspondence
+import checklist, csvio, extsort, keycodec, metrics
 
 mode_column = "mode"
 new_pk_column = "new_pk"
 
+# Both inputs must be sorted by this function of the primary key, the
+# same order that sortcsv.py and prepare.py produce
+sort_key = keycodec.encode_value
+
+MODES = ("add", "update", "remove")
+SORT_BUDGET = 64 * 1024 * 1024
+ERROR_LIMIT = 10
+
 # Read old checklist from inport (sorted by old primary key pk)
+#   or from a binary checklist.Checklist (read in primary key order)
 # Read delta from deltaport (sorted by old primary key pk)
 # Write new state to output
+# With check, both inputs are checked before anything is written (see
+# check_inputs), and sorted first if need be.
+# With processes > 1, the work is split by primary key range (see
+# apply_in_parallel).
+
+def apply_delta(inport, deltaport, pk_col, outport, check=True, processes=1):
+  if check or processes > 1:
+    with metrics.phase("check"):
+      (inport, deltaport) = prepare_inputs(inport, deltaport, pk_col)
+  if processes > 1:
+    with metrics.phase("partitions"):
+      apply_in_parallel(inport, deltaport, pk_col, outport, processes)
+    return
+  if isinstance(inport, checklist.Checklist):
+    header1 = inport.header
+    assert header1[inport.pk_pos] == pk_col
+    reader1 = inport.sorted_rows()
+  else:
+    reader1 = csvio.reader(inport)
+    header1 = next(reader1)
+  reader2 = csvio.reader(deltaport)
+  header2 = next(reader2)
+  with metrics.phase("merge") as p:
+    counts = apply_rows(header1, reader1, header2, reader2, pk_col,
+                        csvio.writer(outport))
+    (added, removed, changed, continued) = counts
+    p.rows = continued + changed + removed
+  report(counts)
+
+# The merge join.  Rows from the old checklist (reader1, header1) and
+# the delta (reader2, header2) are both in primary key order.  Writes
+# the header (unless write_header is false) and the new rows to writer.
+# Returns the number of rows added, removed, changed, and continued.
 
-def apply_delta(inport, deltaport, pk_col, outport):
-  reader1 = csv.reader(inport)
-  header1 = next(reader1)
+def apply_rows(header1, reader1, header2, reader2, pk_col, writer,
+               write_header=True):
   old_pk_pos1 = windex(header1, pk_col)
   assert old_pk_pos1 != None
+  header2 = header2 + []
 
-  reader2 = csv.reader(deltaport)
-  header2 = next(reader2)
   # Every delta has mode and new_pk columns, as well as a primary key
   # column (typically taxonID).
   mode_pos = windex(header2, "mode")
@@ -41,15 +82,15 @@ def apply_delta(inport, deltaport, pk_col, outport):
     return row3
 
   header3 = convert_row(header2)
-
-  writer = csv.writer(outport)
-  writer.writerow(header3)
+  if write_header:
+    writer.writerow(header3)
 
   def write_row(row2):
     writer.writerow(convert_row(row2))
 
-  # Turn a file 1 row into a delta row
-  corr_13 = correspondence(header1, header3)
+  # Turn a file 1 row into a delta row.  (Rows are checked for length
+  # as they are read, so the projection needn't check.)
+  project_13 = correspondence(header1, header3).project
 
   # Cf. diff.py
   row1 = None
@@ -59,6 +100,7 @@ def apply_delta(inport, deltaport, pk_col, outport):
   changed = 0
   continued = 0
   count1 = count2 = 0
+  key1 = key2 = None
 
   while True:
     if row1 == None:
@@ -71,6 +113,12 @@ def apply_delta(inport, deltaport, pk_col, outport):
           print("** Row %s of stdin is ragged" % (count1,), file=sys.stderr)
           assert False
         pk1 = row1[old_pk_pos1]
+        previous = key1
+        key1 = sort_key(pk1)
+        if previous != None and not previous < key1:
+          print("** Input is not sorted by %s: %s follows %s" %
+                (pk_col, pk1, previous), file=sys.stderr)
+          assert False
       except StopIteration:
         row1 = False
         pk1 = None
@@ -81,9 +129,15 @@ def apply_delta(inport, deltaport, pk_col, outport):
           print("# apply: delta %s" % count2, file=sys.stderr)
         count2 += 1
         if len(row2) != len(header2):
-          print("** Row %s of %s is ragged" % (count2,), file=sys.stderr)
+          print("** Row %s of delta is ragged" % (count2,), file=sys.stderr)
           assert False
         pk2 = row2[old_pk_pos2]
+        previous = key2
+        key2 = sort_key(pk2)
+        if previous != None and key2 < previous:
+          print("** Delta is not sorted by %s: %s follows %s" %
+                (pk_col, pk2, previous), file=sys.stderr)
+          assert False
       except StopIteration:
         row2 = False
         pk2 = None
@@ -91,9 +145,9 @@ def apply_delta(inport, deltaport, pk_col, outport):
     if row1 == False and row2 == False:
       break
 
-    if row1 and (not row2 or pk1 < pk2):
+    if row1 and (not row2 or key1 < key2):
       # CARRY OVER.
-      writer.writerow(apply_correspondence(corr_13, row1))
+      writer.writerow(project_13(row1))
       row1 = None
       continued += 1
     elif row2 and row2[mode_pos] == "add":
@@ -101,13 +155,13 @@ def apply_delta(inport, deltaport, pk_col, outport):
       write_row(row2)
       row2 = None
       added += 1
-    elif row2 and (not row1 or pk1 > pk2):
+    elif row2 and (not row1 or key1 > key2):
       print("Invalid mode '%s' for %s < %s (need to sort?)" % (row2[mode_pos], pk2, pk1),
             file=sys.stderr)
       assert False
     else:
       assert row1 and row2
-      assert pk1 == pk2
+      assert key1 == key2
       # row1 updated -> row2
       if row2[mode_pos] == "update":
         write_row(row2)
@@ -121,13 +175,322 @@ def apply_delta(inport, deltaport, pk_col, outport):
         print("Invalid mode %s for %s = %s" % (row2[mode_pos], pk2, pk1),
               file=sys.stderr)
         assert False
+  return (added, removed, changed, continued)
 
+def report(counts):
+  (added, removed, changed, continued) = counts
   print("# apply: Added:     %s" % added, file=sys.stderr)
   print("# apply: Removed:   %s" % removed, file=sys.stderr)
   print("# apply: Changed:   %s" % changed, file=sys.stderr)
   print("# apply: Continued: %s" % continued, file=sys.stderr)
+  metrics.count("rows", continued + changed + removed)
+  metrics.count("delta_rows", added + changed + removed)
+  for (name, n) in (("added", added), ("removed", removed),
+                    ("changed", changed), ("continued", continued)):
+    metrics.count(name, n)
+
+# Parallel apply.  Both inputs are sorted, so a range of primary keys
+# is a contiguous run of rows in each of them.  Split keys are sampled
+# from the old checklist at evenly spaced positions (byte offsets of a
+# CSV file, or positions in a binary checklist's index), the delta is
+# cut at the same keys, and each partition is applied in a separate
+# process, to a temporary file.  The partitions' outputs are then
+# concatenated in key order, which gives the same output as the serial
+# merge.
+
+PARTITIONS_PER_PROCESS = 2
+BLOCK = 1 << 20
+
+def apply_in_parallel(inport, deltaport, pk_col, outport, processes):
+  global _partition_context
+  import multiprocessing, time
+  if isinstance(inport, checklist.Checklist):
+    header1 = inport.header
+    (ranges1, split_keys) = checklist_partitions(
+      inport, processes * PARTITIONS_PER_PROCESS)
+  else:
+    (header1, ranges1, split_keys) = csv_partitions(
+      inport.fileno(), pk_col, processes * PARTITIONS_PER_PROCESS)
+  (header2, ranges2) = delta_partitions(deltaport.fileno(), pk_col, split_keys)
+  nparts = len(ranges1)
+  print("# apply: %s partitions in %s processes" % (nparts, processes),
+        file=sys.stderr)
+
+  writer = csvio.writer(outport)
+  apply_rows(header1, iter(()), header2, iter(()), pk_col, writer)
+  outport.flush()
+
+  # Worker processes close standard input, so pass copies of the files'
+  # descriptors
+  if isinstance(inport, checklist.Checklist):
+    source1 = inport
+  else:
+    source1 = os.dup(inport.fileno())
+  source2 = os.dup(deltaport.fileno())
+  _partition_context = (source1, source2, header1, header2, pk_col,
+                        ranges1, ranges2)
+  start = time.perf_counter()
+  try:
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+      results = pool.imap(apply_partition, range(nparts))
+      totals = [0, 0, 0, 0]
+      for (k, (path, counts, seconds, count1, count2)) in enumerate(results):
+        with open(path, "r", newline="") as infile:
+          shutil.copyfileobj(infile, outport, BLOCK)
+        os.remove(path)
+        totals = [t + c for (t, c) in zip(totals, counts)]
+        print("# apply: partition %s: %s rows + %s delta rows in %.2f s (%.0f rows/s)" %
+              (k, count1, count2, seconds,
+               (count1 + count2) / seconds if seconds > 0 else 0),
+              file=sys.stderr)
+  finally:
+    _partition_context = None
+    if not isinstance(source1, checklist.Checklist):
+      os.close(source1)
+    os.close(source2)
+  print("# apply: %s partitions in %.2f s" % (nparts, time.perf_counter() - start),
+        file=sys.stderr)
+  report(totals)
+
+_partition_context = None
+
+def apply_partition(k):
+  import time
+  (source1, source2, header1, header2, pk_col, ranges1, ranges2) = \
+    _partition_context
+  start = time.perf_counter()
+  if isinstance(source1, checklist.Checklist):
+    (lo, hi) = ranges1[k]
+    reader1 = (source1.row(i) for i in source1.index[lo:hi])
+  else:
+    reader1 = csvio.reader(read_range(source1, ranges1[k]))
+  reader2 = csvio.reader(read_range(source2, ranges2[k]))
+  (fd, path) = tempfile.mkstemp(prefix="apply-", suffix=".csv")
+  with open(fd, "w", newline="", buffering=csvio.BUFFER_SIZE) as outfile:
+    counts = apply_rows(header1, reader1, header2, reader2, pk_col,
+                        csvio.writer(outfile), write_header=False)
+  (added, removed, changed, continued) = counts
+  return (path, counts, time.perf_counter() - start,
+          continued + changed + removed, added + changed + removed)
+
+# Text of a byte range of a file, read a block at a time, so a
+# partition takes constant memory however big it is.  Reads go through
+# os.pread at the range's own position: the processes share the
+# descriptor, and with it the file position, so seeking is not an
+# option.
+
+def read_range(fd, byte_range):
+  (lo, hi) = byte_range
+  raw = RangeFile(fd, lo, hi)
+  return io.TextIOWrapper(io.BufferedReader(raw, csvio.BUFFER_SIZE),
+                          encoding="utf-8")
+
+class RangeFile(io.RawIOBase):
+  def __init__(self, fd, lo, hi):
+    self.fd = fd
+    self.position = lo
+    self.end = hi
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    n = min(len(buffer), self.end - self.position)
+    if n <= 0: return 0
+    data = os.pread(self.fd, n, self.position)
+    buffer[0:len(data)] = data
+    self.position += len(data)
+    return len(data)
 
+# Returns (header, byte ranges, split keys) for a CSV file sorted by
+# primary key.  Range k covers the rows with split_keys[k-1] <= key <
+# split_keys[k] (split_keys[0] is None).  Each range starts at the
+# first record at or after an even share of the file.
 
+def csv_partitions(fd, pk_col, n):
+  size = os.fstat(fd).st_size
+  targets = [size * k // n for k in range(1, n)]
+  recs = record_offsets(fd)
+  (_, header) = next(recs)
+  pk_pos = windex(header, pk_col)
+  starts = None
+  split_keys = [None]
+  for (offset, row) in recs:
+    if starts == None: starts = [offset]
+    while targets and offset >= targets[0]:
+      targets.pop(0)
+      if offset > starts[-1] and row:
+        starts.append(offset)
+        split_keys.append(sort_key(row[pk_pos]))
+    if not targets: break
+  if starts == None: starts = [size]
+  ranges = list(zip(starts, starts[1:] + [size]))
+  return (header, ranges, split_keys)
+
+def checklist_partitions(ck, n):
+  starts = sorted(set(ck.count * k // n for k in range(n)))
+  split_keys = [None] + [sort_key(ck.field(ck.index[i], ck.pk_pos))
+                         for i in starts[1:]]
+  return (list(zip(starts, starts[1:] + [ck.count])), split_keys)
+
+# Generator of (offset, row) for the records of the CSV file open on
+# fd, header first, where offset is where the record starts.  Where a
+# record ends is up to the csv module (a quote inside an unquoted field
+# is just a character, for instance), so the lines are fed to a
+# csv.reader one at a time, and a record ends whenever the reader has
+# just finished a row, as in start.record_chunks.  Reads with pread,
+# leaving the file's position alone.
+
+def record_offsets(fd):
+  infile = io.BufferedReader(RangeFile(fd, 0, os.fstat(fd).st_size), BLOCK)
+  position = 0
+  def lines():
+    nonlocal position
+    for line in infile:
+      position += len(line)
+      yield line.decode("utf-8")
+  offset = 0
+  for row in csv.reader(lines()):
+    yield (offset, row)
+    offset = position
+
+# Returns (header, byte ranges) cutting the delta at the given keys
+
+def delta_partitions(fd, pk_col, split_keys):
+  size = os.fstat(fd).st_size
+  recs = record_offsets(fd)
+  (_, header) = next(recs)
+  pk_pos = windex(header, pk_col)
+  starts = None
+  k = 1
+  for (offset, row) in recs:
+    if starts == None: starts = [offset]
+    if not row: continue
+    key = sort_key(row[pk_pos])
+    while k < len(split_keys) and key >= split_keys[k]:
+      starts.append(offset)
+      k += 1
+    if k == len(split_keys): break
+  if starts == None: starts = [size]
+  starts += [size] * (len(split_keys) - len(starts))
+  return (header, list(zip(starts, starts[1:] + [size])))
+
+# Make sure both inputs are fit to apply before anything is written:
+# spool them to temporary files if they can't be read twice, check
+# them, and sort any input that isn't sorted (then check again).
+# Returns the ports to use instead.
+
+def prepare_inputs(inport, deltaport, pk_col):
+  if not isinstance(inport, checklist.Checklist):
+    inport = csvio.rereadable(inport)
+  deltaport = csvio.rereadable(deltaport)
+  unsorted = check_inputs(inport, deltaport, pk_col)
+  if unsorted:
+    if "input" in unsorted:
+      print("# apply: Input is not sorted by %s; sorting it" % pk_col,
+            file=sys.stderr)
+      inport = sort_port(inport, pk_col)
+    if "delta" in unsorted:
+      print("# apply: Delta is not sorted by %s; sorting it" % pk_col,
+            file=sys.stderr)
+      deltaport = sort_port(deltaport, pk_col)
+    assert not check_inputs(inport, deltaport, pk_col)
+  if not isinstance(inport, checklist.Checklist):
+    inport.seek(0)
+  deltaport.seek(0)
+  return (inport, deltaport)
+
+# Copy of the CSV on port, sorted by primary key, in a temporary file
+
+def sort_port(port, pk_col):
+  port.seek(0)
+  reader = csvio.reader(port)
+  header = next(reader)
+  pk_pos = windex(header, pk_col)
+  spool = tempfile.TemporaryFile("w+", newline="", buffering=csvio.BUFFER_SIZE)
+  writer = csvio.writer(spool)
+  writer.writerow(header)
+  writer.writerows(extsort.sort_rows(reader,
+                                     lambda row: sort_key(row[pk_pos]),
+                                     SORT_BUDGET))
+  spool.seek(0)
+  return spool
+
+# One pass over the primary keys and modes of both inputs, doing what
+# apply_delta's loop does, but writing nothing.  Returns the set of
+# inputs ("input", "delta") that are not sorted.  If both are sorted,
+# also checks that every mode is valid and that every update and remove
+# has a row to apply to, and fails (before any output) if not.
+
+def check_inputs(inport, deltaport, pk_col):
+  unsorted = set()
+  errors = []
+
+  # Problems found before the inputs turn out to be unsorted don't count
+  def error(message):
+    errors.append(message)
+
+  def ordered(rows, name, strict):
+    previous = None
+    for (pk, *rest) in rows:
+      key = sort_key(pk)
+      if previous != None and (key < previous or (strict and key == previous)):
+        if key == previous:
+          error("Two or more rows in %s with %s = %s" % (name, pk_col, pk))
+        else:
+          unsorted.add(name)
+      previous = key
+      yield (key, pk, *rest)
+
+  if isinstance(inport, checklist.Checklist):
+    keys1 = ([inport.field(i, inport.pk_pos)] for i in inport.index)
+  else:
+    inport.seek(0)
+    keys1 = key_columns(csv.reader(inport), "input", [pk_col])
+  deltaport.seek(0)
+  keys2 = key_columns(csv.reader(deltaport), "delta", [pk_col, mode_column])
+  keys1 = ordered(keys1, "input", True)
+  keys2 = ordered(keys2, "delta", False)
+
+  (row1, row2) = (next(keys1, None), next(keys2, None))
+  while (row1 or row2) and not unsorted:
+    if row1 and (not row2 or row1[0] < row2[0]):
+      row1 = next(keys1, None)
+    elif row2 and row2[2] == "add":
+      row2 = next(keys2, None)
+    elif row2 and (not row1 or row1[0] > row2[0]):
+      error("Invalid mode '%s' for %s, which is not in the input" %
+            (row2[2], row2[1]))
+      row2 = next(keys2, None)
+    else:
+      if not row2[2] in MODES:
+        error("Invalid mode '%s' for %s" % (row2[2], row2[1]))
+      (row1, row2) = (next(keys1, None), next(keys2, None))
+  # Finish checking the order
+  for row1 in keys1: pass
+  for row2 in keys2: pass
+
+  if errors and not unsorted:
+    for message in errors[0:ERROR_LIMIT]:
+      print("** apply: %s" % message, file=sys.stderr)
+    print("** apply: %s problems with the inputs; nothing written" % len(errors),
+          file=sys.stderr)
+    assert False
+  return unsorted
+
+# Generator of the given columns of each row, checking for ragged rows
+
+def key_columns(reader, name, columns):
+  header = next(reader)
+  positions = [windex(header, column) for column in columns]
+  assert not None in positions
+  count = 0
+  for row in reader:
+    count += 1
+    if len(row) != len(header):
+      print("** apply: Row %s of %s is ragged" % (count, name), file=sys.stderr)
+      assert False
+    yield [row[pos] for pos in positions]
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="""
@@ -138,7 +501,20 @@ if __name__ == '__main__':
                       help='name of file specifying delta')
   parser.add_argument('--pk',
                       help='name of column containing primary key')
+  parser.add_argument('--input', default=None,
+                      help='binary checklist file to be updated, instead of standard input')
+  parser.add_argument('--check', dest='check', action='store_true',
+                      help='check both inputs before writing anything, sorting them if necessary (default)')
+  parser.add_argument('--no-check', dest='check', action='store_false',
+                      help='read each input once; fail partway through if they are not sorted')
+  parser.set_defaults(check=True)
+  parser.add_argument('--processes', type=int, default=1,
+                      help='number of processes to apply the delta with, each taking a range of primary keys')
+  metrics.add_argument(parser)
   # List of fields stored in database or graphdb should be an arg.
   args=parser.parse_args()
-  with open(args.delta, "r") as inport2:
-    apply_delta(sys.stdin, inport2, args.pk, sys.stdout)
+  inport = checklist.Checklist(args.input) if args.input else sys.stdin
+  with open(args.delta, "r") as inport2, csvio.stdout() as outport:
+    apply_delta(inport, inport2, args.pk, outport, args.check,
+                args.processes)
+  metrics.report("apply", args.metrics_json)
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the pylib tools.
+# Each benchmark runs the tools as subprocesses, the way the pipelines
+# do, and reports wall time and peak resident set size per variant.
+
+import sys, os, csv, time, random, argparse, tempfile, subprocess, filecmp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Run a pylib tool with stdin/stdout redirected to files.
+# Returns (seconds, peak RSS in megabytes).
+
+def run_tool(argv, inpath, outpath):
+  with open(inpath, "r") as infile, open(outpath, "w") as outfile:
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable] + argv, cwd=HERE,
+                            stdin=infile, stdout=outfile,
+                            stderr=subprocess.DEVNULL)
+    (_, status, usage) = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  if proc.returncode != 0:
+    print("** bench: %s failed with status %s" % (argv, proc.returncode),
+          file=sys.stderr)
+    assert False
+  return (elapsed, usage.ru_maxrss / 1024)
+
+def report(name, variant, seconds, rss, same=None):
+  print("%-10s %-24s %8.2f s %8.1f MB%s" %
+        (name, variant, seconds, rss,
+         "" if same == None else ("  same" if same else "  DIFFERENT")))
+
+# Arguments for synth.py, making a synthetic Darwin Core taxon table
+# of the given number of rows, shaped by bench's --depth, --fanout,
+# --synonyms, --collisions and --seed
+
+def synth_argv(args, rows):
+  return ["synth.py", "--rows", str(rows), "--depth", str(args.depth),
+          "--fanout", str(args.fanout), "--synonyms", str(args.synonyms),
+          "--collisions", str(args.collisions), "--seed", str(args.seed)]
+
+# Write a synthetic checklist of --rows rows (CSV) to path.  With
+# churn > 0 it is a later version of the same checklist; with mapping,
+# a taxonID to EOLid mapping is written there too.
+
+def write_synth(path, args, churn=0.0, mapping=None):
+  argv = synth_argv(args, args.rows)
+  if churn > 0:
+    argv += ["--churn", str(churn)]
+  if mapping != None:
+    argv += ["--mapping", mapping]
+  run_tool(argv, os.devnull, path)
+
+def bench_sortcsv(args, tmp):
+  inpath = os.path.join(tmp, "in.csv")
+  write_synth(inpath, args)
+  out1 = os.path.join(tmp, "out1.csv")
+  out2 = os.path.join(tmp, "out2.csv")
+  (s, m) = run_tool(["sortcsv.py", "--key", args.key], inpath, out1)
+  report("sortcsv", "in-memory", s, m)
+  (s, m) = run_tool(["sortcsv.py", "--key", args.key,
+                     "--memory", str(args.memory)], inpath, out2)
+  report("sortcsv", "external %sMB" % args.memory, s, m,
+         filecmp.cmp(out1, out2, shallow=False))
+
+# In-process micro-benchmark: diff.compute_score on every candidate pair
+# against scoring.Scorer on the same candidates.
+
+def bench_score(args, tmp):
+  import diff, scoring
+  from util import read_csv, correspondence
+  path1 = os.path.join(tmp, "1.csv")
+  path2 = os.path.join(tmp, "2.csv")
+  write_synth(path1, args)
+  write_synth(path2, args, churn=args.churn)
+  with open(path1, "r") as in1, open(path2, "r") as in2:
+    (header1, all_rows1) = read_csv(in1, "taxonID")
+    (header2, all_rows2) = read_csv(in2, "taxonID")
+  diff.INDEX_BY = ["taxonID", "scientificName", "canonicalName"]
+  diff.pk_pos2 = header2.index("taxonID")
+  keys2_by_property = diff.index_keys_by_property(all_rows2, header2)
+  corr_12 = correspondence(header1, header2)
+  weights = diff.get_weights(header1, header2, diff.INDEX_BY)
+  positions = diff.indexed_positions(header1, diff.INDEX_BY)
+  work = [(key1, row1, diff.row_properties(row1, header1, positions))
+          for (key1, row1) in all_rows1.items()]
+  pairs = sum(len(keys2_by_property.get(prop, ()))
+              for (_, _, props) in work for prop in props)
+
+  start = time.perf_counter()
+  expect = [[[diff.compute_score(row1, all_rows2[key2], corr_12, weights)
+              for key2 in keys2_by_property.get(prop, ())]
+             for prop in props]
+            for (_, row1, props) in work]
+  s = time.perf_counter() - start
+  print("score      %-24s %8.2f s %8.2f us/pair  (%s pairs)" %
+        ("compute_score", s, 1e6 * s / max(pairs, 1), pairs))
+
+  start = time.perf_counter()
+  scorer = scoring.Scorer(all_rows1, all_rows2, corr_12, weights)
+  setup = time.perf_counter() - start
+  start = time.perf_counter()
+  got = []
+  for i in range(0, len(work), diff.SCORE_BLOCK):
+    block = work[i:i+diff.SCORE_BLOCK]
+    got.extend(scorer.block_scores([key1 for (key1, _, _) in block],
+                                   [props for (_, _, props) in block],
+                                   keys2_by_property))
+  s = time.perf_counter() - start
+  print("score      %-24s %8.2f s %8.2f us/pair  setup %.2f s%s" %
+        ("Scorer (%s)" % ("numpy" if scoring.numpy else "python"),
+         s, 1e6 * s / max(pairs, 1), setup,
+         "  same" if got == expect else "  DIFFERENT"))
+
+# In-process: memory taken by each pkcheck method while checking the
+# taxonIDs of a synthetic checklist, per million keys.  Memory is the
+# peak allocated (tracemalloc) in one pass; time is from a second pass
+# without tracemalloc, which slows things down a lot.
+
+def bench_pkcheck(args, tmp):
+  import tracemalloc, pkcheck
+  path = os.path.join(tmp, "in.csv")
+  write_synth(path, args)
+
+  def check(method):
+    checker = pkcheck.make_checker(method, "taxonID", args.rows)
+    with open(path, "r") as infile:
+      reader = csv.reader(infile)
+      next(reader)
+      for row in reader:
+        checker.add(row[0])
+    checker.finish()
+
+  for method in pkcheck.METHODS:
+    tracemalloc.start()
+    check(method)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    check(method)
+    s = time.perf_counter() - start
+    mb = peak / (1024 * 1024)
+    print("pkcheck    %-24s %8.2f s %8.1f MB  %8.1f MB per million keys" %
+          (method, s, mb, mb * 1000000 / max(args.rows, 1)))
+
+# In-process: classifying names as 'scientific' by a plain regex
+# search (as start.py used to) and by start.is_scientific, then
+# start.clean_name over the same names.  The names imitate a big
+# checklist: canonical names are shared among a taxon and its
+# synonyms, and some rows have authorities with years.
+
+def bench_names(args, tmp):
+  import re, start
+  rnd = random.Random(1)
+  rows = []
+  while len(rows) < args.rows:
+    canonical = "Genus%s species%s" % (rnd.randrange(args.rows // 20 + 1),
+                                       rnd.randrange(args.rows))
+    for k in range(1 + int(rnd.expovariate(1 / 2))):   # taxon + synonyms
+      what = rnd.randrange(4)
+      if what == 0:
+        scientific = "%s Author, %s" % (canonical, rnd.randrange(1758, 2021))
+      elif what == 1:
+        scientific = "%s Author" % canonical
+      elif what == 2:
+        scientific = canonical
+      else:
+        scientific = ""
+      rows.append([canonical, scientific])
+  rows = rows[0:args.rows]
+  names = [name for row in rows for name in row]
+
+  sci_re = re.compile(" [1-2][0-9]{3}\\b")
+  start_time = time.perf_counter()
+  expect = [bool(sci_re.search(name)) for name in names]
+  s = time.perf_counter() - start_time
+  print("names      %-24s %8.2f s %8.2f us/name" %
+        ("regex", s, 1e6 * s / len(names)))
+  start_time = time.perf_counter()
+  got = [start.is_scientific(name) for name in names]
+  s = time.perf_counter() - start_time
+  print("names      %-24s %8.2f s %8.2f us/name%s" %
+        ("is_scientific", s, 1e6 * s / len(names),
+         "  same" if got == expect else "  DIFFERENT"))
+  start_time = time.perf_counter()
+  cleaned = sum(1 for row in rows if start.clean_name(list(row), 0, 1))
+  s = time.perf_counter() - start_time
+  print("names      %-24s %8.2f s %8.2f us/row  (%s cleaned)" %
+        ("clean_name", s, 1e6 * s / len(rows), cleaned))
+
+# In-process: util.apply_correspondence, as it used to be (a closure
+# called per column) and as it is now (a compiled projection), on an
+# apply.py-like workload (every column carried over) and a
+# hierarchy.py-like one (a few columns kept, some new and empty).
+
+def bench_correspondence(args, tmp):
+  from util import correspondence, apply_correspondence, MISSING
+  path = os.path.join(tmp, "in.csv")
+  write_synth(path, args)
+  with open(path, "r") as infile:
+    reader = csv.reader(infile)
+    header = next(reader)
+    rows = list(reader)
+
+  def old_apply_correspondence(corr, rowa):
+    (n, v) = corr
+    if len(rowa) != n:
+      assert False
+    def m(j):
+      i = v[j]
+      return rowa[i] if i != None else MISSING
+    return [m(j) for j in range(0, len(v))]
+
+  workloads = [
+    ("apply", header),
+    ("hierarchy", ["taxonID", "parentNameUsageID", "taxonRank",
+                   "scientificName", "canonicalName", "kingdom",
+                   "acceptedNameUsageID", "taxonomicStatus"]),
+  ]
+  for (name, out_header) in workloads:
+    corr = correspondence(header, out_header)
+    variants = [
+      ("closure (old)", lambda: [old_apply_correspondence(corr, row)
+                                 for row in rows]),
+      ("apply_correspondence", lambda: [apply_correspondence(corr, row)
+                                        for row in rows]),
+      ("project", lambda: list(map(corr.project, rows))),
+      ("project_batch", lambda: corr.project_batch(rows)),
+    ]
+    expect = None
+    for (variant, run) in variants:
+      start = time.perf_counter()
+      got = run()
+      s = time.perf_counter() - start
+      if expect == None:
+        (expect, same) = (got, "")
+      else:
+        same = "  same" if got == expect else "  DIFFERENT"
+      print("%-10s %-24s %8.2f s %8.2f us/row%s" %
+            (name, variant, s, 1e6 * s / max(len(rows), 1), same))
+
+# Throughput of each filter, run as a subprocess on a synthetic
+# checklist, in rows and megabytes of input per second.  apply gets a
+# delta changing a churn fraction of the rows, idmap a mapping for
+# every taxonID, subset the checklist's own hierarchy (whose first row
+# is the root of everything), and scatter the delta.
+
+def bench_io(args, tmp):
+  inpath = os.path.join(tmp, "in.csv")
+  mappath = os.path.join(tmp, "map.csv")
+  write_synth(inpath, args, mapping=mappath)
+  sortedpath = os.path.join(tmp, "sorted.csv")
+  run_tool(["sortcsv.py", "--key", "taxonID"], inpath, sortedpath)
+  deltapath = os.path.join(tmp, "delta.csv")
+  rnd = random.Random(2)
+  with open(sortedpath, "r") as sortedfile, \
+       open(deltapath, "w", newline="") as deltafile:
+    reader = csv.reader(sortedfile)
+    header = next(reader)
+    delta_writer = csv.writer(deltafile)
+    delta_writer.writerow(["mode", "new_pk"] + header)
+    for row in reader:
+      if rnd.random() < args.churn:
+        if rnd.random() < 0.5:
+          delta_writer.writerow(["update", row[0]] + row[0:7] + ["ds9"])
+        else:
+          delta_writer.writerow(["remove", ""] + row)
+  with open(inpath, "r") as infile:
+    reader = csv.reader(infile)
+    next(reader)
+    root = next(reader)[0]
+
+  tools = [
+    ("start", ["start.py", "--pk", "taxonID"], inpath),
+    ("project", ["project.py", "--drop", "datasetID"], inpath),
+    ("idmap", ["idmap.py", "--mapping", mappath], inpath),
+    ("scatter", ["scatter.py", "--dest", os.path.join(tmp, "scatter")],
+     deltapath),
+    ("apply", ["apply.py", "--delta", deltapath, "--pk", "taxonID"],
+     sortedpath),
+    ("subset", ["subset.py", "--hierarchy", inpath, "--root", root],
+     inpath),
+  ]
+  outpath = os.path.join(tmp, "out.csv")
+  for (name, argv, path) in tools:
+    (s, m) = run_tool(argv, path, outpath)
+    with open(path, "r") as infile:
+      count = sum(1 for row in csv.reader(infile)) - 1
+    mb = os.path.getsize(path) / (1024 * 1024)
+    print("io         %-24s %8.2f s %8.1f MB  %8.0f rows/s %6.1f MB/s" %
+          (name, s, m, count / s, mb / s))
+
+# End to end: synthetic checklists (see synth.py) of each size in
+# --sizes, run through start, prepare, sortcsv, idmap, hierarchy,
+# subset, diff and apply as a pipeline would.  Each step is reported,
+# and with --results, appended to that file as a line of JSON, along
+# with the generator's parameters, the git commit and the Python
+# version, so that runs can be compared.  The tools that take
+# --metrics-json contribute their phase timings.
+
+SUITE_STEPS = ["synth", "start", "prepare", "sortcsv", "idmap", "hierarchy",
+               "subset", "diff", "apply"]
+
+def bench_suite(args, tmp):
+  import json, platform
+  sizes = [int(size) for size in args.sizes.split(",")] if args.sizes \
+          else [args.rows]
+  steps = args.steps.split(",") if args.steps else SUITE_STEPS
+  params = {"depth": args.depth, "fanout": args.fanout,
+            "synonyms": args.synonyms, "collisions": args.collisions,
+            "churn": args.churn, "seed": args.seed}
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                            capture_output=True, text=True).stdout.strip()
+  except OSError:
+    commit = None
+  for size in sizes:
+    path = lambda name: os.path.join(tmp, "%s-%s" % (size, name))
+    synth = synth_argv(args, size) + ["--tsv"]
+    # (step, argv, stdin, stdout, whether it takes --metrics-json).
+    # Steps that make an input for a later step are run even if they
+    # are not to be reported.
+    plan = [
+      ("synth", synth + ["--mapping", path("map.csv")],
+       os.devnull, path("v1.tsv"), False),
+      ("synth v2", synth + ["--churn", str(args.churn)],
+       os.devnull, path("v2.tsv"), False),
+      ("start", ["start.py", "--input", path("v1.tsv"), "--pk", "taxonID"],
+       os.devnull, path("s1.csv"), True),
+      ("start v2", ["start.py", "--input", path("v2.tsv"), "--pk", "taxonID"],
+       os.devnull, path("s2.csv"), True),
+      ("prepare", ["prepare.py", "--key", "taxonID"],
+       path("s1.csv"), path("p1.csv"), True),
+      ("sortcsv", ["sortcsv.py", "--key", "taxonID"],
+       path("s2.csv"), path("p2.csv"), False),
+      ("idmap", ["idmap.py", "--mapping", path("map.csv")],
+       path("s1.csv"), path("m1.csv"), True),
+      ("hierarchy", ["hierarchy.py", "--mapping", path("map.csv")],
+       path("s1.csv"), path("h1.csv"), True),
+      ("subset", ["subset.py", "--hierarchy", path("s1.csv"), "--root", None],
+       path("s1.csv"), path("sub.csv"), True),
+      ("diff", ["diff.py", "--target", path("p2.csv")],
+       path("p1.csv"), path("delta.csv"), True),
+      ("apply", ["apply.py", "--delta", path("delta.csv"), "--pk", "taxonID"],
+       path("p1.csv"), path("a1.csv"), True),
+    ]
+    needed = {"synth", "start", "prepare", "sortcsv", "diff"}
+    for (step, argv, inpath, outpath, measured) in plan:
+      tool = step.split()[0]
+      if not tool in steps and not tool in needed: continue
+      if tool == "subset":
+        # The first phylum, a child of the root
+        with open(path("s1.csv"), "r") as infile:
+          reader = csv.reader(infile)
+          next(reader)
+          root_id = next(reader)[0]
+          argv[-1] = next(row for row in reader if row[1] == root_id)[0]
+      metrics_path = path("metrics.json")
+      if measured:
+        argv = argv + ["--metrics-json", metrics_path]
+      (s, m) = run_tool(argv, inpath, outpath)
+      phases = None
+      if measured:
+        with open(metrics_path, "r") as infile:
+          phases = json.loads(infile.readlines()[-1])["phases"]
+      if not tool in steps: continue
+      report("suite", "%s %s" % (step, size), s, m)
+      if args.results:
+        record = {"suite": "dwc", "step": step, "tool": tool, "argv": argv[1:],
+                  "rows": size, "seconds": round(s, 3),
+                  "max_rss_mb": round(m, 1),
+                  "rows_per_second": round(size / s, 1) if s > 0 else None,
+                  "phases": phases, "params": params, "commit": commit,
+                  "python": platform.python_version(),
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        with open(args.results, "a") as outfile:
+          print(json.dumps(record), file=outfile)
+
+BENCHMARKS = {
+  "sortcsv": bench_sortcsv,
+  "score": bench_score,
+  "pkcheck": bench_pkcheck,
+  "names": bench_names,
+  "correspondence": bench_correspondence,
+  "io": bench_io,
+  "suite": bench_suite,
+}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="""
+    Run a benchmark on synthetic data, reporting wall time and peak
+    memory for each variant of the tool being measured.
+    """)
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+                      help='which benchmark to run')
+  parser.add_argument('--rows', type=int, default=100000,
+                      help='number of rows of synthetic input')
+  parser.add_argument('--key', default="taxonID",
+                      help='sort key for the sortcsv benchmark')
+  parser.add_argument('--churn', type=float, default=0.1,
+                      help='fraction of rows that change between versions')
+  parser.add_argument('--memory', type=float, default=16,
+                      help='memory budget in megabytes for external sorting')
+  parser.add_argument('--sizes',
+                      help='for the suite: a,b,c numbers of rows to run it at, instead of --rows (e.g. 10000,1000000,10000000)')
+  parser.add_argument('--steps',
+                      help='for the suite: which of %s to run (default all)' %
+                      ",".join(SUITE_STEPS))
+  parser.add_argument('--results',
+                      help='for the suite: file to append results to, as lines of JSON')
+  parser.add_argument('--depth', type=int, default=7,
+                      help='levels in the synthetic tree (synth.py)')
+  parser.add_argument('--fanout', type=int, default=6,
+                      help='children per synthetic taxon (synth.py)')
+  parser.add_argument('--synonyms', type=float, default=0.2,
+                      help='fraction of synthetic usages that are synonyms (synth.py)')
+  parser.add_argument('--collisions', type=float, default=0.01,
+                      help='fraction of synthetic names that collide (synth.py)')
+  parser.add_argument('--seed', type=int, default=1,
+                      help='seed for the synthetic checklists (synth.py)')
+  args=parser.parse_args()
+  with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+    BENCHMARKS[args.benchmark](args, tmp)
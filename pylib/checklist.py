@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Binary checklist files, for tools that would otherwise re-parse the
+# same big CSV file over and over.  Written once (e.g. after start.py),
+# then read through mmap.
+
+# Layout (integers are little-endian):
+#   magic "PLCKLST2"
+#   uint32 number of columns, uint32 primary key column, uint64 number of rows
+#   for each column: uint64 position of its offsets, uint64 position of its data
+#   uint64 position of the primary key index
+#   header: for each column, uint32 length + UTF-8 name
+#   for each column:
+#     offsets: (rows + 1) uint64, relative to the start of the column's data
+#     data: the column's values, UTF-8, concatenated
+#   primary key index: rows uint32 row numbers, in primary key order
+# Primary keys are in the numeric-aware order of keycodec.py, the same
+# order that sortcsv.py, prepare.py and apply.py use.
+
+import sys, os, csv, mmap, struct, tempfile, argparse
+from array import array
+from util import windex
+import extsort, keycodec
+
+MAGIC = b"PLCKLST2"
+BLOCK = 65536
+
+def is_checklist(path):
+  if not path or not os.path.isfile(path): return False
+  with open(path, "rb") as infile:
+    return infile.read(len(MAGIC)) == MAGIC
+
+# Read CSV from inport and write it as a checklist file at path
+
+def write_checklist(inport, pk_col, path):
+  reader = csv.reader(inport)
+  header = next(reader)
+  pk_pos = windex(header, pk_col)
+  if pk_pos == None:
+    print("** checklist: No %s column in header %s" % (pk_col, header),
+          file=sys.stderr)
+    assert False
+  width = len(header)
+  tmpdir = os.path.dirname(os.path.abspath(path))
+  datas = [tempfile.TemporaryFile(dir=tmpdir) for j in range(width)]
+  offsetss = [tempfile.TemporaryFile(dir=tmpdir) for j in range(width)]
+  positions = [0] * width
+  pending = [array('Q', [0]) for j in range(width)]
+  pks = extsort.Sorter(lambda entry: keycodec.encode_value(entry[0]))
+  count = 0
+  for row in reader:
+    if len(row) != width:
+      print("** checklist: Row %s is ragged: %s" % (count + 1, row),
+            file=sys.stderr)
+      assert False
+    for j in range(width):
+      value = row[j].encode('utf-8')
+      datas[j].write(value)
+      positions[j] += len(value)
+      pending[j].append(positions[j])
+    pks.add([row[pk_pos], str(count)])
+    count += 1
+    if count % BLOCK == 0:
+      for j in range(width):
+        pending[j].tofile(offsetss[j])
+        pending[j] = array('Q')
+    if count % 500000 == 0:
+      print("# checklist: %s" % count, file=sys.stderr)
+  for j in range(width):
+    pending[j].tofile(offsetss[j])
+  if count >= 2**32:
+    print("** checklist: Too many rows (%s)" % count, file=sys.stderr)
+    assert False
+
+  with open(path + ".new", "wb") as outfile:
+    outfile.write(MAGIC)
+    outfile.write(struct.pack("<IIQ", width, pk_pos, count))
+    directory_pos = outfile.tell()
+    outfile.write(bytes(8 * (2 * width + 1)))
+    for name in header:
+      name = name.encode('utf-8')
+      outfile.write(struct.pack("<I", len(name)))
+      outfile.write(name)
+    directory = []
+    for j in range(width):
+      directory.append(outfile.tell())
+      copy_file(offsetss[j], outfile)
+      directory.append(outfile.tell())
+      copy_file(datas[j], outfile)
+    directory.append(outfile.tell())
+    index = array('I')
+    previous = None
+    for [pk, i] in pks.finish():
+      if pk == previous:
+        print("** checklist: Two or more rows with %s = %s" % (pk_col, pk),
+              file=sys.stderr)
+        assert False
+      previous = pk
+      index.append(int(i))
+      if len(index) >= BLOCK:
+        index.tofile(outfile)
+        index = array('I')
+    index.tofile(outfile)
+    outfile.seek(directory_pos)
+    outfile.write(struct.pack("<%sQ" % len(directory), *directory))
+  os.replace(path + ".new", path)
+  print("checklist: Wrote %s rows, %s columns to %s" % (count, width, path),
+        file=sys.stderr)
+
+def copy_file(infile, outfile):
+  infile.seek(0)
+  while True:
+    chunk = infile.read(1 << 20)
+    if not chunk: break
+    outfile.write(chunk)
+  infile.close()
+
+# Read-only access to a checklist file.  Behaves like the dict returned
+# by util.read_csv: a mapping from primary key to row (a fresh list of
+# strings), iterating in file order.  Nothing is parsed until it is
+# asked for.
+
+class Checklist:
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "rb")
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    m = self.map
+    assert m[0:len(MAGIC)] == MAGIC
+    p = len(MAGIC)
+    (width, self.pk_pos, self.count) = struct.unpack_from("<IIQ", m, p)
+    p += 16
+    directory = struct.unpack_from("<%sQ" % (2 * width + 1), m, p)
+    p += 8 * (2 * width + 1)
+    self.header = []
+    for j in range(width):
+      (n,) = struct.unpack_from("<I", m, p)
+      self.header.append(m[p+4:p+4+n].decode('utf-8'))
+      p += 4 + n
+    view = memoryview(m)
+    self.offsets = []
+    self.data = []
+    for j in range(width):
+      (offsets_pos, data_pos) = directory[2*j:2*j+2]
+      self.offsets.append(view[offsets_pos:offsets_pos+8*(self.count+1)].cast('Q'))
+      self.data.append(data_pos)
+    index_pos = directory[2 * width]
+    self.index = view[index_pos:index_pos+4*self.count].cast('I')
+
+  def close(self):
+    self.index = self.offsets = None
+    self.map.close()
+    self.file.close()
+
+  def field_bytes(self, i, j):
+    offsets = self.offsets[j]
+    start = self.data[j]
+    return self.map[start+offsets[i]:start+offsets[i+1]]
+
+  def field(self, i, j):
+    return self.field_bytes(i, j).decode('utf-8')
+
+  def row(self, i):
+    return [self.field(i, j) for j in range(len(self.header))]
+
+  # Row number for the given primary key, or None (binary search)
+  def find(self, pk):
+    target = keycodec.encode_value(pk)
+    (lo, hi) = (0, self.count)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      i = self.index[mid]
+      probe = keycodec.encode_value(self.field(i, self.pk_pos))
+      if probe < target:
+        lo = mid + 1
+      elif probe > target:
+        hi = mid
+      else:
+        return i
+    return None
+
+  # Rows in primary key order
+  def sorted_rows(self):
+    for i in self.index:
+      yield self.row(i)
+
+  def __getitem__(self, pk):
+    i = self.find(pk)
+    if i == None: raise KeyError(pk)
+    return self.row(i)
+
+  def get(self, pk, default=None):
+    i = self.find(pk)
+    if i == None: return default
+    return self.row(i)
+
+  def __contains__(self, pk):
+    return self.find(pk) != None
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    return self.keys()
+
+  def keys(self):
+    for i in range(self.count):
+      yield self.field(i, self.pk_pos)
+
+  def values(self):
+    for i in range(self.count):
+      yield self.row(i)
+
+  def items(self):
+    for i in range(self.count):
+      row = self.row(i)
+      yield (row[self.pk_pos], row)
+
+def write_csv(checklist, outport, sort=False):
+  writer = csv.writer(outport)
+  writer.writerow(checklist.header)
+  writer.writerows(checklist.sorted_rows() if sort else checklist.values())
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="""
+    Convert CSV (read from standard input) to a binary checklist file,
+    or with --dump, a binary checklist file back to CSV (written to
+    standard output).
+    """)
+  parser.add_argument('--output',
+                      help='name of binary checklist file to write')
+  parser.add_argument('--pk', default="taxonID",
+                      help='name of column containing primary key')
+  parser.add_argument('--dump',
+                      help='name of binary checklist file to convert to CSV')
+  parser.add_argument('--sorted', action='store_true',
+                      help='with --dump, write rows in primary key order')
+  args=parser.parse_args()
+  if args.dump:
+    write_csv(Checklist(args.dump), sys.stdout, args.sorted)
+  else:
+    write_checklist(sys.stdin, args.pk, args.output)
@@ -0,0 +1,58 @@
+# Reading and writing CSV in big blocks, for the filters.
+
+# Writing a row at a time through sys.stdout is slow, especially into
+# a pipe, because its buffer is small and every write goes through
+# newline translation.  stdout() gives a text file on the same
+# descriptor with a big buffer and no translation (as the csv module
+# wants), and the tools write to it with writerows where they can.
+# The file must be flushed when the tool is done with it.
+# Reading doesn't gain from a bigger buffer than sys.stdin's, but
+# batches() groups rows for loops that work on a batch at a time.
+
+# params is a (delimiter, quotechar, quoting) triple as returned by
+# util.csv_parameters; the default is CSV.  The tools write CSV,
+# whatever they read.
+
+import sys, csv, shutil, tempfile
+from itertools import islice
+
+BUFFER_SIZE = 1 << 20
+BATCH_ROWS = 2000
+
+CSV = (",", '"', csv.QUOTE_MINIMAL)
+
+def reader(port, params=CSV):
+  (d, q, g) = params
+  return csv.reader(port, delimiter=d, quotechar=q, quoting=g)
+
+def writer(port, params=CSV):
+  (d, q, g) = params
+  return csv.writer(port, delimiter=d, quotechar=q, quoting=g)
+
+# Lists of up to size rows at a time
+
+def batches(rows, size=BATCH_ROWS):
+  rows = iter(rows)
+  while True:
+    batch = list(islice(rows, size))
+    if not batch: return
+    yield batch
+
+def stdout():
+  sys.stdout.flush()
+  return open(sys.stdout.fileno(), "w", buffering=BUFFER_SIZE, newline="",
+              encoding=sys.stdout.encoding, errors=sys.stdout.errors,
+              closefd=False)
+
+def open_output(path):
+  return open(path, "w", newline="", buffering=BUFFER_SIZE)
+
+# A port that can be read more than once: port itself if it can seek,
+# otherwise a temporary file holding a copy of what's left on it
+
+def rereadable(port):
+  if port.seekable(): return port
+  spool = tempfile.TemporaryFile("w+", newline="")
+  shutil.copyfileobj(port, spool, BUFFER_SIZE)
+  spool.seek(0)
+  return spool
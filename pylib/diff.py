@@ -18,17 +18,22 @@ With some indexing, we can do it in approximately linear time.
 
 # -----
 
-import sys, io, argparse, csv
+import sys, io, argparse, csv, hashlib
 from functools import reduce
+from itertools import islice
 from util import read_csv, windex, MISSING, \
                  correspondence, precolumn, apply_correspondence
+import scoring, checklist, metrics
 
-def matchings(inport1, inport2, pk_col, indexed, managed, outport):
+def matchings(inport1, inport2, pk_col, indexed, managed, outport,
+              processes=1, batch=False, columnar=False, incremental=False):
   global INDEX_BY, pk_pos1, pk_pos2
   INDEX_BY = indexed.split(",")    # kludge
 
-  (header1, all_rows1) = read_csv(inport1, pk_col)
-  (header2, all_rows2) = read_csv(inport2, pk_col)
+  with metrics.phase("read") as p:
+    (header1, all_rows1) = read_input(inport1, pk_col, columnar)
+    (header2, all_rows2) = read_input(inport2, pk_col, columnar)
+    p.rows = len(all_rows1) + len(all_rows2)
 
   pk_pos1 = windex(header1, pk_col)
   pk_pos2 = windex(header2, pk_col)
@@ -37,10 +42,28 @@ def matchings(inport1, inport2, pk_col, indexed, managed, outport):
   # Positions in header2 of the managed columns ("fields of interest")
   foi_positions = [windex(header2, name) for name in managed.split(",")]
 
-  rows2_by_property = index_rows_by_property(all_rows2, header2)
-  (best_rows_in_file1, best_rows_in_file2) = \
-    find_best_matches(header1, header2, all_rows1, all_rows2,
-                      pk_col, rows2_by_property)
+  # Rows that persist with the same primary key and the same managed
+  # values are carries; only the rest need to be scored.
+  carried = {}
+  (residue1, residue2) = (all_rows1, all_rows2)
+  if incremental:
+    with metrics.phase("carries"):
+      carried = find_carries(all_rows1, all_rows2, header1, header2,
+                             foi_positions)
+    residue1 = Leftovers(all_rows1, carried)
+    residue2 = Leftovers(all_rows2, carried)
+
+  (best_keys_in_file1, best_keys_in_file2) = ({}, {})
+  if len(residue2) > 0:
+    with metrics.phase("index") as p:
+      keys2_by_property = index_keys_by_property(residue2, header2)
+      p.rows = len(residue2)
+    with metrics.phase("score") as p:
+      (best_keys_in_file1, best_keys_in_file2) = \
+        find_best_matches(header1, header2, residue1, residue2,
+                          pk_col, keys2_by_property, processes, batch,
+                          check=not incremental)
+      p.rows = len(residue1)
 
   writer = csv.writer(outport)
 
@@ -70,52 +93,62 @@ def matchings(inport1, inport2, pk_col, indexed, managed, outport):
     fake[pk_pos2] = MISSING
     write_row("remove", key1, fake)
 
-  # Now emit the matches.  
-  # Process 1st file for changes and deletions
-  corr_12 = correspondence(header1, header2)
-  carry_count = 0
-  update_count = 0
-  remove_count = 0
-  stats = [[0, 0, 0, ([], [], [])] for col in header2]
-  seen = {}
-  for (key1, row1) in all_rows1.items():
-    best_rows2 = best_rows_in_file2.get(key1)
-    if best_rows2:
-      (score, rows2) = best_rows2
-      (matchp, mode) = check_match([row1], rows2, score,
-                                   best_rows_in_file1)
-      if matchp:
-        row2 = rows2[0]
-        seen[row2[pk_pos2]] = True
-        if analyze_changes(row1, row2, foi_positions, corr_12, stats):
-          write_row("update", key1, row2)
-          update_count += 1
+  with metrics.phase("write") as p:
+    # Now emit the matches.  
+    # Process 1st file for changes and deletions
+    corr_12 = correspondence(header1, header2)
+    carry_count = 0
+    update_count = 0
+    remove_count = 0
+    stats = [[0, 0, 0, ([], [], [])] for col in header2]
+    seen = {}
+    for (key1, row1) in all_rows1.items():
+      if key1 in carried:
+        seen[key1] = True
+        carry_count += 1
+        continue
+      best_keys2 = best_keys_in_file2.get(key1)
+      if best_keys2:
+        (score, keys2) = best_keys2
+        (matchp, mode) = check_match([key1], keys2, score,
+                                     best_keys_in_file1)
+        if matchp:
+          row2 = all_rows2[keys2[0]]
+          seen[keys2[0]] = True
+          if analyze_changes(row1, row2, foi_positions, corr_12, stats):
+            write_row("update", key1, row2)
+            update_count += 1
+          else:
+            # write_row("carry", key1, row2)
+            carry_count += 1
         else:
-          # write_row("carry", key1, row2)
-          carry_count += 1
+          # Delete row1.
+          # No need to report; check_match has already done that.
+          flush_row(row1)
+          remove_count += 1
       else:
-        # Delete row1.
-        # No need to report; check_match has already done that.
+        # Unmatched; remove
         flush_row(row1)
         remove_count += 1
-    else:
-      # Unmatched; remove
-      flush_row(row1)
-      remove_count += 1
-
-  # Find additions in 2nd file
-  add_count = 0
-  for (key2, row2) in all_rows2.items():
-    if not key2 in seen:
-      if key2 in all_rows1:
-        print("Collision: %s" % key2)
-      write_row("add", key2, row2)
-      add_count += 1
-  seen = None
+
+    # Find additions in 2nd file
+    add_count = 0
+    for (key2, row2) in all_rows2.items():
+      if not key2 in seen:
+        if key2 in all_rows1:
+          print("Collision: %s" % key2)
+        write_row("add", key2, row2)
+        add_count += 1
+    seen = None
+    p.rows = carry_count + add_count + remove_count + update_count
 
   print("%s carries, %s additions, %s removals, %s updates" %
         (carry_count, add_count, remove_count, update_count,),
         file=sys.stderr)
+  metrics.count("rows", len(all_rows1) + len(all_rows2))
+  for (name, n) in (("carries", carry_count), ("additions", add_count),
+                    ("removals", remove_count), ("updates", update_count)):
+    metrics.count(name, n)
   for j in range(0, len(header2)):
     (a, c, d, (qs, cs, ds)) = stats[j]
     if a > 0:
@@ -131,6 +164,82 @@ def matchings(inport1, inport2, pk_col, indexed, managed, outport):
       print("  %s: %s cleared %s" % (header2[j], d, x),
             file=sys.stderr)
 
+# An input is either a CSV port or a binary checklist.Checklist, which
+# can be used as is.
+
+def read_input(inport, pk_col, columnar):
+  if isinstance(inport, checklist.Checklist):
+    if inport.header[inport.pk_pos] != pk_col:
+      print("** Checklist %s has primary key %s, not %s" %
+            (inport.path, inport.header[inport.pk_pos], pk_col),
+            file=sys.stderr)
+      assert False
+    return (inport.header, inport)
+  return read_csv(inport, pk_col, columnar=columnar)
+
+# The rows of all_rows whose keys are not carried, fetched from all_rows
+# as they are asked for, so that what is left after the carries isn't
+# a copy of a ColumnarRows or Checklist input in a dict.  Carried keys
+# are keys of both inputs.
+
+class Leftovers:
+  def __init__(self, all_rows, carried):
+    self.all_rows = all_rows
+    self.carried = carried
+
+  def __len__(self):
+    return len(self.all_rows) - len(self.carried)
+
+  def __contains__(self, key):
+    return key in self.all_rows and not key in self.carried
+
+  def __getitem__(self, key):
+    assert not key in self.carried
+    return self.all_rows[key]
+
+  def get(self, key, default=None):
+    if key in self.carried: return default
+    return self.all_rows.get(key, default)
+
+  def keys(self):
+    return (key for key in self.all_rows.keys() if not key in self.carried)
+
+  def __iter__(self):
+    return self.keys()
+
+  def items(self):
+    return ((key, row) for (key, row) in self.all_rows.items()
+            if not key in self.carried)
+
+  def values(self):
+    return (row for (key, row) in self.items())
+
+# Linear pass to find rows that have the same primary key in both
+# inputs and the same values in all the managed columns (those that
+# analyze_changes looks at), going by a hash of those values.
+# Returns a dict whose keys are the primary keys of those rows.
+
+def find_carries(all_rows1, all_rows2, header1, header2, foi_positions):
+  corr_12 = correspondence(header1, header2)
+  positions2 = [pos2 for pos2 in foi_positions if pos2 != None]
+  positions1 = [precolumn(corr_12, pos2) for pos2 in positions2]
+  hashes2 = {key2: row_hash(row2, positions2)
+             for (key2, row2) in all_rows2.items()}
+  carried = {}
+  for (key1, row1) in all_rows1.items():
+    h = hashes2.get(key1)
+    if h != None and h == row_hash(row1, positions1):
+      carried[key1] = True
+  print("%s unchanged rows carried without scoring" % len(carried),
+        file=sys.stderr)
+  return carried
+
+# Hash of the values at the given positions (None = MISSING)
+
+def row_hash(row, positions):
+  values = [(row[pos] if pos != None else MISSING) for pos in positions]
+  return hashlib.sha1("\x1f".join(values).encode('utf-8')).digest()
+
 # for readability
 SAMPLES = 3
 
@@ -161,25 +270,24 @@ def analyze_changes(row1, row2, foi_positions, corr_12, stats):
 
 WAD_SIZE = 4
 
-def check_match(rows1, rows2, score, best_rows_in_file1):
-  global pk_pos1, pk_pos2
-  keys1 = [row1[pk_pos1] for row1 in rows1]
-  keys2 = [row2[pk_pos2] for row2 in rows2]
-  if len(rows1) > 1:
-    if len(rows1) < WAD_SIZE:
-      # keys1 = [row1[pk_pos1] for row1 in rows1]
+# keys1 and keys2 are the primary keys of the tied best rows on each
+# side; best_keys_in_file1 is as from find_best_matches.
+
+def check_match(keys1, keys2, score, best_keys_in_file1):
+  if len(keys1) > 1:
+    if len(keys1) < WAD_SIZE:
       print("Tie: multiple old %s -> new %s (score %s)" %
             (keys1, keys2[0], score),
             file=sys.stderr)
     return (False, "contentious")
-  elif len(rows2) > 1:
-    if len(rows2) < WAD_SIZE:
+  elif len(keys2) > 1:
+    if len(keys2) < WAD_SIZE:
       # does not occur in 0.9/1.1
       print("Tie: old %s -> multiple new %s (score %s)" %
             (keys1[0], keys2, score),
             file=sys.stderr)
     return (False, "ambiguous")
-  elif len(rows2) == 0:
+  elif len(keys2) == 0:
     return (False, "unevaluated")
   elif score < 100:
     print("Old %s match to new %s is too weak to use (score %s)" % (keys1[0], keys2[0], score),
@@ -188,13 +296,11 @@ def check_match(rows1, rows2, score, best_rows_in_file1):
   else:
     key1 = keys1[0]
     key2 = keys2[0]
-    best_rows1 = best_rows_in_file1.get(key2)
-    if best_rows1:
-      (score3, rows3) = best_rows1
-      pk_pos1 = 0    # FIX ME FIX ME
-      if len(rows3) > 1:
-        if len(rows3) < WAD_SIZE:
-          keys3 = [row3[pk_pos1] for row3 in rows3]
+    best_keys1 = best_keys_in_file1.get(key2)
+    if best_keys1:
+      (score3, keys3) = best_keys1
+      if len(keys3) > 1:
+        if len(keys3) < WAD_SIZE:
           print("Old %s (score %s) colliding at %s" % (keys3, score, key2,),
                 file=sys.stderr)
         return (False, "collision")
@@ -203,8 +309,7 @@ def check_match(rows1, rows2, score, best_rows_in_file1):
         return (False, "inferior")
       else:
         assert score == score3
-        row3 = rows3[0]
-        key3 = row3[pk_pos1]
+        key3 = keys3[0]
         if key1 != key3:
           print("%s = %s != %s, score %s, back %s" % (key1, key2, key3, score, score3),
                 file=sys.stderr)
@@ -239,8 +344,12 @@ def get_weights(header_b, header_a, index_by):
     w = w + w
   return weights
 
+# With check, it is an error for nothing to match at all (with
+# --incremental, the rows left after carries may well share nothing).
+
 def find_best_matches(header1, header2, all_rows1, all_rows2,
-                      pk_col, rows2_by_property):
+                      pk_col, keys2_by_property, processes=1, batch=False,
+                      check=True):
   global pk_pos1, pk_pos2
   assert len(all_rows2) > 0
   corr_12 = correspondence(header1, header2)
@@ -249,47 +358,150 @@ def find_best_matches(header1, header2, all_rows1, all_rows2,
   print("Indexed: %s" % positions, file=sys.stderr)
   weights = get_weights(header1, header2, INDEX_BY)    # parallel to header2
   print("Weights: %s" % weights, file=sys.stderr)
+  scorer = None
+  if batch:
+    scorer = scoring.Scorer(all_rows1, all_rows2, corr_12, weights)
+
+  if processes > 1:
+    (best_keys_in_file1, best_keys_in_file2, prop_count) = \
+      score_in_parallel(header1, all_rows1, all_rows2, keys2_by_property,
+                        corr_12, weights, positions, processes, scorer)
+  else:
+    (best_keys_in_file1, best_keys_in_file2, prop_count) = \
+      score_rows(all_rows1.items(), header1, all_rows2, keys2_by_property,
+                 corr_12, weights, positions, scorer)
+
+  print("%s properties" % prop_count, file=sys.stderr)
+  if check and len(all_rows1) > 0 and len(all_rows2) > 0:
+    assert len(best_keys_in_file1) > 0
+    assert len(best_keys_in_file2) > 0
+  return (best_keys_in_file1, best_keys_in_file2)
+
+# Find best matches for the given (key1, row1) pairs.  Returns tables
+#   best_keys_in_file1: key2 -> (score, keys1)
+#   best_keys_in_file2: key1 -> (score, keys2)
+# holding primary keys rather than rows, so that rows of a ColumnarRows
+# or Checklist are only materialized while they are being scored.  If
+# a scoring.Scorer is given, it is used in place of compute_score.
+
+def score_rows(items1, header1, all_rows2, keys2_by_property, corr_12,
+               weights, positions, scorer=None):
   no_info = (-1, [])
 
-  best_rows_in_file2 = {}    # key1 -> (score, rows2)
-  best_rows_in_file1 = {}    # key2 -> (score, rows1)
+  best_keys_in_file2 = {}    # key1 -> (score, keys2)
+  best_keys_in_file1 = {}    # key2 -> (score, keys1)
   prop_count = 0
-  for (key1, row1) in all_rows1.items():
+  for (key1, row1, props, row_scores) in \
+        scored_rows(items1, header1, positions, keys2_by_property, scorer):
     # The following check is also enforced by start.py... flush them here?
-    best2_so_far = no_info
-    best_rows_so_far2 = no_info
+    best_keys_so_far2 = no_info
 
-    for prop in row_properties(row1, header1, positions):
+    for k in range(len(props)):
+      prop = props[k]
       if prop_count % 500000 == 0:
         print(prop_count, file=sys.stderr)
       prop_count += 1
-      for row2 in rows2_by_property.get(prop, []):
-        key2 = row2[pk_pos2]
-        score = compute_score(row1, row2, corr_12, weights)
-        best_rows_so_far1 = best_rows_in_file1.get(key2, no_info)
+      candidates = keys2_by_property.get(prop, [])
+      if scorer:
+        scores = row_scores[k]
+      else:
+        scores = (compute_score(row1, all_rows2[key2], corr_12, weights)
+                  for key2 in candidates)
+      for (key2, score) in zip(candidates, scores):
+        best_keys_so_far1 = best_keys_in_file1.get(key2, no_info)
 
         # Update best file2 match for row1
-        (score2_so_far, rows2) = best_rows_so_far2
+        (score2_so_far, keys2) = best_keys_so_far2
         if score > score2_so_far:
-          best_rows_so_far2 = (score, [row2])
-        elif score == score2_so_far and not row2 in rows2:
-          if len(rows2) < WAD_SIZE: rows2.append(row2)
+          best_keys_so_far2 = (score, [key2])
+        elif score == score2_so_far and not key2 in keys2:
+          if len(keys2) < WAD_SIZE: keys2.append(key2)
 
         # Update best file1 match for row2
-        (score1_so_far, rows1) = best_rows_so_far1
+        (score1_so_far, keys1) = best_keys_so_far1
         if score > score1_so_far:
-          best_rows_in_file1[key2] = (score, [row1])
-        elif score == score1_so_far and not row1 in rows1:
-          if len(rows1) < WAD_SIZE: rows1.append(row1)
-
-    if best_rows_so_far2 != no_info:
-      best_rows_in_file2[key1] = best_rows_so_far2
-
-  print("%s properties" % prop_count, file=sys.stderr)
-  if len(all_rows1) > 0 and len(all_rows2) > 0:
-    assert len(best_rows_in_file1) > 0
-    assert len(best_rows_in_file2) > 0
-  return (best_rows_in_file1, best_rows_in_file2)
+          best_keys_in_file1[key2] = (score, [key1])
+        elif score == score1_so_far and not key1 in keys1:
+          if len(keys1) < WAD_SIZE: keys1.append(key1)
+
+    if best_keys_so_far2 != no_info:
+      best_keys_in_file2[key1] = best_keys_so_far2
+
+  return (best_keys_in_file1, best_keys_in_file2, prop_count)
+
+# Yields (key1, row1, props, row_scores) for each row in items1, where
+# props are the row's properties and row_scores are its candidates'
+# scores as computed by the scorer (None if there is no scorer).  Rows
+# are scored a block at a time.
+
+SCORE_BLOCK = 4096
+
+def scored_rows(items1, header1, positions, keys2_by_property, scorer):
+  if not scorer:
+    for (key1, row1) in items1:
+      yield (key1, row1, row_properties(row1, header1, positions), None)
+    return
+  items1 = iter(items1)
+  while True:
+    block = list(islice(items1, SCORE_BLOCK))
+    if not block: break
+    props_list = [row_properties(row1, header1, positions)
+                  for (key1, row1) in block]
+    scores_list = scorer.block_scores([key1 for (key1, row1) in block],
+                                      props_list, keys2_by_property)
+    for ((key1, row1), props, row_scores) in \
+          zip(block, props_list, scores_list):
+      yield (key1, row1, props, row_scores)
+
+# Parallel version of score_rows over all of file 1.
+# File 1 is cut into contiguous shards, one per task.  Worker processes
+# are forked so that they share the indexes without copying them.  The
+# workers' tables are merged in shard order, so that the tie lists come
+# out exactly as they would from a serial run.
+
+SHARDS_PER_PROCESS = 4
+
+def score_in_parallel(header1, all_rows1, all_rows2, keys2_by_property,
+                      corr_12, weights, positions, processes, scorer=None):
+  global _shard_context
+  import multiprocessing
+  keys1 = list(all_rows1.keys())
+  nshards = processes * SHARDS_PER_PROCESS
+  size = (len(keys1) + nshards - 1) // nshards or 1
+  shards = [keys1[i:i+size] for i in range(0, len(keys1), size)]
+  _shard_context = (shards, header1, all_rows1, all_rows2, keys2_by_property,
+                    corr_12, weights, positions, scorer)
+  print("Scoring %s shards in %s processes" % (len(shards), processes),
+        file=sys.stderr)
+  try:
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+      results = pool.map(score_shard, range(len(shards)))
+  finally:
+    _shard_context = None
+
+  best_keys_in_file1 = {}
+  best_keys_in_file2 = {}
+  prop_count = 0
+  for (best1, best2, count) in results:
+    prop_count += count
+    best_keys_in_file2.update(best2)
+    for (key2, (score, keys1)) in best1.items():
+      have = best_keys_in_file1.get(key2)
+      if have == None or score > have[0]:
+        best_keys_in_file1[key2] = (score, keys1)
+      elif score == have[0]:
+        for key1 in keys1:
+          if len(have[1]) < WAD_SIZE: have[1].append(key1)
+  return (best_keys_in_file1, best_keys_in_file2, prop_count)
+
+_shard_context = None
+
+def score_shard(i):
+  (shards, header1, all_rows1, all_rows2, keys2_by_property,
+   corr_12, weights, positions, scorer) = _shard_context
+  items1 = ((key1, all_rows1[key1]) for key1 in shards[i])
+  return score_rows(items1, header1, all_rows2, keys2_by_property,
+                    corr_12, weights, positions, scorer)
 
 def compute_score(row1, row2, corr_12, weights):
   s = 0
@@ -313,26 +525,28 @@ def compute_score(row1, row2, corr_12, weights):
 
 LIMIT=100
 
-def index_rows_by_property(all_rows, header):
+# property -> primary keys of the rows (up to LIMIT + 1) that have it
+
+def index_keys_by_property(all_rows, header):
   positions = indexed_positions(header, INDEX_BY)
-  rows_by_property = {}
+  keys_by_property = {}
   entry_count = 0
   for (key, row) in all_rows.items():
     for property in row_properties(row, header, positions):
-      rows = rows_by_property.get(property)
-      if rows != None:
-        if len(rows) <= LIMIT:
-          if len(rows) == LIMIT:
+      keys = keys_by_property.get(property)
+      if keys != None:
+        if len(keys) <= LIMIT:
+          if len(keys) == LIMIT:
             print("%s+ rows with property %s" % (LIMIT, property,),
                   file=sys.stderr)
-          rows.append(row)
+          keys.append(key)
           entry_count += 1
       else:
-        rows_by_property[property] = [row]
+        keys_by_property[property] = [key]
         entry_count += 1
-  print("%s properties" % (len(rows_by_property),),
+  print("%s properties" % (len(keys_by_property),),
         file=sys.stderr)
-  return rows_by_property
+  return keys_by_property
 
 # Future: exclude really ephemeral properties like taxonID
 
@@ -361,7 +575,7 @@ if __name__ == '__main__':
     file annotated with ids for initial state records, via matching.
     """)
   parser.add_argument('--target',
-                      help='name of file specifying target state')
+                      help='name of file specifying target state (CSV or binary checklist)')
   parser.add_argument('--pk',
                       default="taxonID",
                       help='name of column containing primary key')
@@ -374,7 +588,23 @@ if __name__ == '__main__':
   parser.add_argument('--manage',
                       default=managed,
                       help='names of columns under version control')
+  parser.add_argument('--processes', type=int, default=1,
+                      help='number of processes to use for scoring')
+  parser.add_argument('--batch', action='store_true',
+                      help='score candidates in batches over interned column values (faster with NumPy)')
+  parser.add_argument('--columnar', action='store_true',
+                      help='hold the inputs column by column to save memory')
+  parser.add_argument('--incremental', action='store_true',
+                      help='carry rows with unchanged key and managed columns without scoring them')
+  metrics.add_argument(parser)
   # List of fields stored in database or graphdb should be an arg.
   args=parser.parse_args()
-  with open(args.target, "r") as inport2:
-    matchings(sys.stdin, inport2, args.pk, args.index, args.manage, sys.stdout)
+  if checklist.is_checklist(args.target):
+    matchings(sys.stdin, checklist.Checklist(args.target),
+              args.pk, args.index, args.manage, sys.stdout,
+              args.processes, args.batch, args.columnar, args.incremental)
+  else:
+    with open(args.target, "r") as inport2:
+      matchings(sys.stdin, inport2, args.pk, args.index, args.manage, sys.stdout,
+                args.processes, args.batch, args.columnar, args.incremental)
+  metrics.report("diff", args.metrics_json)
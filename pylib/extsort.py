@@ -0,0 +1,93 @@
+# External-memory merge sort for CSV rows.
+#  - Rows are collected into runs that fit within a memory budget
+#  - Each run is sorted and spilled to a temporary CSV file
+#  - The runs are k-way merged back into a single sorted stream
+# If everything fits in one run, nothing is written to disk.
+
+import sys, os, csv, heapq, tempfile
+
+# Default memory budget for a run, in bytes
+DEFAULT_BUDGET = 256 * 1024 * 1024
+
+# Maximum number of runs merged at once; more than this and the runs
+# are merged in several passes.
+MAX_FANIN = 64
+
+# Rough size in bytes of a row held in memory: list object plus one
+# str object per field.
+def row_bytes(row):
+  return 56 + 8 * len(row) + sum(49 + len(x) for x in row)
+
+# Returns an iterator over the rows, sorted according to key.
+# Like sorted(), the sort is stable.
+
+def sort_rows(rows, key, budget=DEFAULT_BUDGET, tmpdir=None):
+  sorter = Sorter(key, budget, tmpdir)
+  for row in rows:
+    sorter.add(row)
+  return sorter.finish()
+
+# For sorting rows that arrive one at a time, e.g. when a single pass
+# over the input feeds more than one sort.
+
+class Sorter:
+  def __init__(self, key, budget=DEFAULT_BUDGET, tmpdir=None):
+    self.key = key
+    self.budget = budget
+    self.tmpdir = tmpdir
+    self.runs = []
+    self.run = []
+    self.size = 0
+    self.count = 0
+
+  def add(self, row):
+    self.run.append(row)
+    self.count += 1
+    self.size += row_bytes(row)
+    if self.size >= self.budget:
+      self.runs.append(spill_run(self.run, self.key, self.tmpdir))
+      self.run = []
+      self.size = 0
+
+  # Returns an iterator over everything added, in sorted order
+  def finish(self):
+    (key, tmpdir, runs, run) = (self.key, self.tmpdir, self.runs, self.run)
+    self.runs = self.run = None
+    if not runs:
+      run.sort(key=key)
+      return iter(run)
+    if run:
+      runs.append(spill_run(run, key, tmpdir))
+    print("# extsort: %s runs spilled to disk" % len(runs), file=sys.stderr)
+    while len(runs) > MAX_FANIN:
+      runs = [merge_to_run(runs[i:i+MAX_FANIN], key, tmpdir)
+              for i in range(0, len(runs), MAX_FANIN)]
+    return merge_runs(runs, key)
+
+def spill_run(run, key, tmpdir):
+  run.sort(key=key)
+  (fd, path) = tempfile.mkstemp(prefix="extsort-", suffix=".csv", dir=tmpdir)
+  with open(fd, "w", newline="") as outfile:
+    csv.writer(outfile).writerows(run)
+  return path
+
+def merge_to_run(paths, key, tmpdir):
+  (fd, path) = tempfile.mkstemp(prefix="extsort-", suffix=".csv", dir=tmpdir)
+  with open(fd, "w", newline="") as outfile:
+    csv.writer(outfile).writerows(merge_runs(paths, key))
+  return path
+
+# Generator; deletes the run files once they have been consumed.
+# heapq.merge prefers earlier iterables on ties, which keeps the sort
+# stable because runs are in input order.
+
+def merge_runs(paths, key):
+  files = [open(path, "r", newline="") for path in paths]
+  try:
+    for row in heapq.merge(*[csv.reader(f) for f in files], key=key):
+      yield row
+  finally:
+    for f in files:
+      f.close()
+    for path in paths:
+      os.remove(path)
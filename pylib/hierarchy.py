@@ -6,34 +6,34 @@
 # Output: a hierarchical items table, with one row per item
 
 import sys, csv, argparse
-import idmap
-from util import apply_correspondence, correspondence, windex, MISSING
+from array import array
+from bisect import bisect_left
+import csvio, idmap, metrics, traverse
+from util import correspondence, check_length, windex, MISSING
 
 item_id_col = "EOLid"
 parent_id_col = "parentEOLid"
 usage_id_col = "taxonID"
+preorder_col = "preorder"
+postorder_col = "postorder"
 
-def hierarchy(keep, infile, outfile, usage_to_item):
+# With intervals, two more columns, preorder and postorder, give each
+# item's position in a depth-first walk of the hierarchy (see
+# traverse.Topology.intervals), so that later tools can test whether
+# an item is in a subtree by comparing numbers (subset.py --intervals).
+# Items that are not reached from a root get no numbers.
 
-  unmapped = []
-  def itemize(usage_id):
-    item_id = usage_to_item.get(usage_id)
-    if item_id: return item_id
-    item_id = "[%s]" % usage_id
-    usage_to_item[usage_id] = item_id
-    unmapped.append(usage_id)
-    return item_id
+# Positions of the input columns hierarchy needs, the output header,
+# and the correspondence from input to output columns
 
-  item_rows = {}
-  reader = csv.reader(infile)
+def read_header(reader, keep):
   header = next(reader)
-
   usage_pos = windex(header, usage_id_col)
   assert usage_pos != None
-  item_id_pos = windex(header, item_id_col)
-  parent_usage_pos = windex(header, "parentNameUsageID")
-  accepted_usage_pos = windex(header, "acceptedNameUsageID")
-  status_pos = windex(header, "taxonomicStatus")
+  positions = (usage_pos,
+               windex(header, "parentNameUsageID"),
+               windex(header, "acceptedNameUsageID"),
+               windex(header, "taxonomicStatus"))
   if keep == "":
     keep_cols = []
   else:
@@ -43,92 +43,326 @@ def hierarchy(keep, infile, outfile, usage_to_item):
   out_header = [item_id_col, parent_id_col, usage_id_col] + keep_cols
   corr = correspondence(header, out_header)
   print("Correspondence: %s" % (corr,), file=sys.stderr)
+  return (positions, out_header, corr)
+
+# Two ways to test whether a usage is accepted; the first decides,
+# and if complain is true, disagreement is reported
+
+def is_accepted(row, positions, complain=True):
+  (usage_pos, _, accepted_usage_pos, status_pos) = positions
+  usage_id = row[usage_pos]
+  au = MISSING
+  if accepted_usage_pos != None:
+    au = row[accepted_usage_pos]
+  indication_1 = (au == MISSING or au == usage_id)
+  if complain:
+    stat = row[status_pos] if status_pos != None else "accepted"
+    indication_2 = (stat == "accepted" or stat == "valid")
+    if indication_1 != indication_2:
+      print("Conflicting evidence concerning acceptedness: %s %s %s" %
+             (usage_id, au, stat),
+            file=sys.stderr)
+  return indication_1
+
+def hierarchy(keep, infile, outfile, usage_to_item, intervals=False):
+
+  unmapped = []
+  def itemize(usage_id):
+    item_id = usage_to_item.get(usage_id)
+    if item_id: return item_id
+    item_id = "[%s]" % usage_id
+    usage_to_item[usage_id] = item_id
+    unmapped.append(usage_id)
+    return item_id
+
+  reader = csv.reader(infile)
+  (positions, out_header, corr) = read_header(reader, keep)
+  (usage_pos, parent_usage_pos, _, _) = positions
+  project = corr.project
 
   item_rows = {} # usage id to output row
   seen_item_ids = {}
   parent = {}    # usage id to parent usage id
   roots = []
-  children = {}
+  topo = traverse.Topology()    # children of accepted usages
   synonyms = 0
   discards = []
 
   writer = csv.writer(outfile)
-  writer.writerow(out_header)
+  if intervals:
+    writer.writerow(out_header + [preorder_col, postorder_col])
+  else:
+    writer.writerow(out_header)
 
-  for row in reader:
-    usage_id = row[usage_pos]
+  with metrics.phase("read") as p:
+    for row in reader:
+      usage_id = row[usage_pos]
 
-    # Two ways to test whether a usage is accepted
-    au = MISSING
-    if accepted_usage_pos != None:
-      au = row[accepted_usage_pos]
-    indication_1 = (au == MISSING or au == usage_id)
-    stat = row[status_pos] if status_pos != None else "accepted"
-    indication_2 = (stat == "accepted" or stat == "valid")
-    if indication_1 != indication_2:
-      print("Conflicting evidence concerning acceptedness: %s %s %s" %
-             (usage_id, au, stat),
-            file=sys.stderr)
-
-    # Ignore any non-accepted rows
-    if indication_1:
-      item_id = itemize(usage_id)
-      if item_id in seen_item_ids:
-        discards.append((usage_id, item_id, seen_item_ids[item_id]))
+      # Ignore any non-accepted rows
+      if is_accepted(row, positions):
+        item_id = itemize(usage_id)
+        if item_id in seen_item_ids:
+          discards.append((usage_id, item_id, seen_item_ids[item_id]))
+        else:
+          seen_item_ids[item_id] = usage_id
+          if len(row) != corr.n: check_length(corr, row)
+          item_row = project(row)
+          if item_row[0] != MISSING and item_row[0] != item_id:
+            print("For usage %s, mapping %s will override input file %s" %
+                  (usage_id, item_id, item_row[0]),
+                  file=sys.stderr)
+          item_row[0] = item_id
+          item_rows[usage_id] = item_row    # don't need all of it
+          parent[usage_id] = row[parent_usage_pos]
       else:
-        seen_item_ids[item_id] = usage_id
-        item_row = apply_correspondence(corr, row)
-        if item_row[0] != MISSING and item_row[0] != item_id:
-          print("For usage %s, mapping %s will override input file %s" %
-                (usage_id, item_id, item_row[0]),
-                file=sys.stderr)
-        item_row[0] = item_id
-        item_rows[usage_id] = item_row    # don't need all of it
-        parent[usage_id] = row[parent_usage_pos]
-    else:
-      synonyms += 1
+        synonyms += 1
+    p.rows = len(item_rows) + synonyms
 
   # Now fill in parent pointers, generate the output, and get the topology
-  for (usage_id, item_row) in item_rows.items():
-
-    parent_usage_id = parent[usage_id]
-    if parent_usage_id in item_rows:
-      parent[usage_id] = parent_usage_id
-      item_row[1] = itemize(parent_usage_id)
-      ch = children.get(parent_usage_id)
-      if ch:
-        ch.append(usage_id)
+  with metrics.phase("link") as p:
+    for (usage_id, item_row) in item_rows.items():
+
+      parent_usage_id = parent[usage_id]
+      if parent_usage_id in item_rows:
+        parent[usage_id] = parent_usage_id
+        item_row[1] = itemize(parent_usage_id)
+        topo.add_child(parent_usage_id, usage_id)
       else:
-        children[parent_usage_id] = [usage_id]
-    else:
-      roots.append(usage_id)
+        roots.append(usage_id)
 
-    writer.writerow(item_row)
+      if not intervals:
+        writer.writerow(item_row)
+    p.rows = len(item_rows)
 
+  metrics.count("rows", len(item_rows) + synonyms)
+  metrics.count("items", len(item_rows))
+  with_children = sum(1 for ch in topo.children if ch)
   print("%s items, %s roots, %s items with children, %s non-items, %s unmapped, %s discards" %
-        (len(item_rows), len(roots), len(children), synonyms, len(unmapped), len(discards)),
+        (len(item_rows), len(roots), with_children, synonyms, len(unmapped), len(discards)),
         file=sys.stderr)
 
+  root_numbers = [topo.node(root) for root in roots]
+  if intervals:
+    with metrics.phase("intervals"):
+      (preorder, postorder) = topo.intervals(root_numbers)
+      for (usage_id, item_row) in item_rows.items():
+        i = topo.node(usage_id)
+        if preorder[i] < 0:
+          writer.writerow(item_row + [MISSING, MISSING])
+        else:
+          writer.writerow(item_row + [str(preorder[i]), str(postorder[i])])
+
+  # As a diagnostic service, check that the hierarchy is well-formed.
+  with metrics.phase("check"):
+    seen = topo.reach(root_numbers, synonyms=False)
+    if len(seen) != len(item_rows):
+      print("Reached only %s items out of %s by recursive descent" %
+            (len(seen), len(item_rows)),
+            file=sys.stderr)
+      throttle = 0
+      for usage_id in item_rows:
+        if not usage_id in seen:
+          throttle += 1
+          if throttle <= 10:
+            print("Missed: %s = %s" % (usage_id, itemize(usage_id)),
+                  file=sys.stderr)
+
+# With --streaming, the input is read twice instead of being held in
+# memory, so that memory goes with the number of accepted usages and
+# not with the size of their rows.  The first pass numbers the
+# accepted usages in input order and keeps only their usage ids,
+# parent usage ids and mapped item ids, in IdColumns.  Then sorting
+# the ids finds the discards (usages whose item id, or usage id, was
+# already taken) and each usage's parent number, the well-formedness
+# check and intervals run over a ParentTopology, and the second pass
+# writes each item row as soon as it is read, in the same order, and
+# with the same contents, as hierarchy() would.  Standard input is
+# spooled to a temporary file if it can't be read twice.
+
+def hierarchy_streaming(keep, infile, outfile, usage_to_item, intervals=False):
+
+  def item_id(usage_id):
+    return usage_to_item.get(usage_id) or "[%s]" % usage_id
+
+  infile = csvio.rereadable(infile)
+  reader = csv.reader(infile)
+  (positions, out_header, corr) = read_header(reader, keep)
+  (usage_pos, parent_usage_pos, _, _) = positions
+  project = corr.project
+
+  usage_ids = IdColumn()      # accepted usage number -> usage id
+  parent_ids = IdColumn()     # -> parent usage id, as given
+  item_ids = IdColumn()       # -> mapped item id, or empty
+  synonyms = 0
+  with metrics.phase("pass 1") as p:
+    for row in reader:
+      if is_accepted(row, positions):
+        usage_id = row[usage_pos]
+        usage_ids.append(usage_id)
+        parent_ids.append(row[parent_usage_pos])
+        item_ids.append(usage_to_item.get(usage_id) or MISSING)
+      else:
+        synonyms += 1
+    p.rows = len(usage_ids) + synonyms
+
+  with metrics.phase("index"):
+    n = len(usage_ids)
+    discarded = bytearray(n)
+
+    # A usage is discarded if an earlier one has the same item id ...
+    order = item_ids.order()
+    items = item_ids.values
+    for k in range(1, n):
+      (i, j) = (order[k-1], order[k])
+      if items[j] == items[i] and not item_ids.empty(items[j]):
+        discarded[j] = 1
+
+    # ... or the same usage id (hence the same item id, mapped or not)
+    usage_ids.same_form(parent_ids)
+    order = usage_ids.order()
+    values = usage_ids.values
+    keys = usage_ids.like([values[i] for i in order])
+    unmapped = 0
+    for k in range(n):
+      i = order[k]
+      if k > 0 and keys[k] == keys[k-1]:
+        discarded[i] = 1
+      elif item_ids.empty(items[i]):
+        unmapped += 1
+    item_ids = items = None
+
+    # Parent numbers: the first usage with the parent usage id, if it
+    # wasn't discarded
+    parents = array('i', [-1]) * n
+    roots = array('i')
+    parent_values = parent_ids.values
+    for i in range(n):
+      if discarded[i]: continue
+      pid = parent_values[i]
+      k = bisect_left(keys, pid)
+      if k < n and keys[k] == pid and not discarded[order[k]]:
+        parents[i] = order[k]
+      else:
+        roots.append(i)
+    parent_ids = parent_values = keys = order = None
+    topo = traverse.ParentTopology(parents)
+
+  items = n - sum(discarded)
+  metrics.count("rows", n + synonyms)
+  metrics.count("items", items)
+  print("%s items, %s roots, %s items with children, %s non-items, %s unmapped, %s discards" %
+        (items, len(roots), topo.with_children(), synonyms, unmapped, n - items),
+        file=sys.stderr)
+
+  if intervals:
+    with metrics.phase("intervals"):
+      (preorder, postorder) = topo.intervals(roots)
+
+  writer = csv.writer(outfile)
+  if intervals:
+    writer.writerow(out_header + [preorder_col, postorder_col])
+  else:
+    writer.writerow(out_header)
+
+  with metrics.phase("pass 2") as p:
+    infile.seek(0)
+    reader = csv.reader(infile)
+    next(reader)
+    i = -1
+    for row in reader:
+      if not is_accepted(row, positions, complain=False): continue
+      i += 1
+      if discarded[i]: continue
+      usage_id = row[usage_pos]
+      iid = item_id(usage_id)
+      if len(row) != corr.n: check_length(corr, row)
+      item_row = project(row)
+      if item_row[0] != MISSING and item_row[0] != iid:
+        print("For usage %s, mapping %s will override input file %s" %
+              (usage_id, iid, item_row[0]),
+              file=sys.stderr)
+      item_row[0] = iid
+      if parents[i] >= 0:
+        item_row[1] = item_id(row[parent_usage_pos])
+      if intervals:
+        if preorder[i] < 0:
+          item_row += [MISSING, MISSING]
+        else:
+          item_row += [str(preorder[i]), str(postorder[i])]
+      writer.writerow(item_row)
+    p.rows = items
+
   # As a diagnostic service, check that the hierarchy is well-formed.
-  seen = {}
-
-  def descend(usage_id):
-    seen[usage_id] = True
-    for child_id in children.get(usage_id, ()):
-      descend(child_id)
-  for root in roots:
-    descend(root)
-  if len(seen) != len(item_rows):
-    print("Reached only %s items out of %s by recursive descent" %
-          (len(seen), len(item_rows)),
-          file=sys.stderr)
-    throttle = 0
-    for usage_id in item_rows:
-      if not usage_id in seen:
-        throttle += 1
-        if throttle <= 10:
-          print("Missed: %s = %s" % (usage_id, itemize(usage_id)),
-                file=sys.stderr)
+  with metrics.phase("check"):
+    seen = topo.reach(roots)
+    if len(seen) != items:
+      print("Reached only %s items out of %s by recursive descent" %
+            (len(seen), items),
+            file=sys.stderr)
+      throttle = 0
+      for i in range(n):
+        if not discarded[i] and not seen.has_number(i):
+          throttle += 1
+          if throttle <= 10:
+            print("Missed: %s = %s" % (usage_ids[i], item_id(usage_ids[i])),
+                  file=sys.stderr)
+
+# A column of taxon ids, one per accepted usage.  While every id is a
+# decimal number without leading zeros, or empty, the column is an
+# array of integers (-1 for empty), 8 bytes per id; after the first id
+# that isn't, it's a list of strings.  Columns whose values are
+# compared with one another must be in the same form (same_form).
+
+class IdColumn:
+  def __init__(self):
+    self.values = array('q')
+
+  def numeric(self):
+    return isinstance(self.values, array)
+
+  def append(self, tid):
+    values = self.values
+    if isinstance(values, array):
+      if tid == MISSING:
+        values.append(-1)
+        return
+      if (tid.isdigit() and tid.isascii() and len(tid) < 19 and
+          (tid[0] != "0" or tid == "0")):
+        values.append(int(tid))
+        return
+      self.to_strings()
+    self.values.append(tid)
+
+  def to_strings(self):
+    if self.numeric():
+      self.values = [str(v) if v >= 0 else MISSING for v in self.values]
+
+  def same_form(self, other):
+    if not (self.numeric() and other.numeric()):
+      self.to_strings()
+      other.to_strings()
+
+  def empty(self, value):
+    return value == -1 or value == MISSING
+
+  def __len__(self):
+    return len(self.values)
+
+  # The id itself
+  def __getitem__(self, i):
+    v = self.values[i]
+    if self.numeric():
+      return str(v) if v >= 0 else MISSING
+    return v
+
+  # Positions in order of their values; equal values stay in input order
+  def order(self):
+    return array('i', sorted(range(len(self.values)),
+                             key=self.values.__getitem__))
+
+  # Other values, in this column's form
+  def like(self, values):
+    return array('q', values) if self.numeric() else values
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="""
@@ -139,5 +373,19 @@ if __name__ == '__main__':
                       help="a,b,c where a,b,c are columns to keep")
   parser.add_argument('--mapping',
                       help='name of file where usage id to item id mapping is stored')
+  parser.add_argument('--index', action='store_true',
+                      help='look up through an on-disk index of the mapping file, built if needed')
+  parser.add_argument('--intervals', action='store_true',
+                      help='add preorder and postorder columns, for testing membership in subtrees')
+  parser.add_argument('--streaming', action='store_true',
+                      help='read the input twice (spooling standard input to a temporary file if need be) instead of holding its rows in memory')
+  metrics.add_argument(parser)
   args=parser.parse_args()
-  hierarchy(args.keep, sys.stdin, sys.stdout, idmap.read_mappings(args.mapping))
+  with metrics.phase("mappings"):
+    mappings = idmap.open_mappings(args.mapping, args.index)
+  if args.streaming:
+    hierarchy_streaming(args.keep, sys.stdin, sys.stdout, mappings,
+                        args.intervals)
+  else:
+    hierarchy(args.keep, sys.stdin, sys.stdout, mappings, args.intervals)
+  metrics.report("hierarchy", args.metrics_json)
@@ -4,14 +4,25 @@
 # Assumes CSV input and output.
 # This is pretty specific to EOL, where items are called 'pages'.
 
-import sys, csv, argparse
+import sys, os, csv, sqlite3, argparse, functools, tempfile, pathlib
+import csvio, extsort, keycodec, metrics
 
 item_id_col = "EOLid"
 parent_item_id_col = "parentEOLid"
 
 def apply_mappings(mappings, inport, outport):
-  reader = csv.reader(inport)
+  reader = csvio.reader(inport)
   header = next(reader)
+  (out_header, rows) = map_rows(mappings, header, reader)
+  writer = csvio.writer(outport)
+  writer.writerow(out_header)
+  with metrics.phase("map"):
+    writer.writerows(rows)
+
+# Returns (out_header, out_rows) where out_rows is a generator of the
+# mapped rows.  Can be used as a stage in an in-process pipeline.
+
+def map_rows(mappings, header, reader):
   usage_id_pos = windex(header, "taxonID")
   parent_usage_id_pos = windex(header, "parentNameUsageID")
   accepted_usage_id_pos = windex(header, "acceptedNameUsageID")
@@ -21,73 +32,83 @@ def apply_mappings(mappings, inport, outport):
     print("** map: No taxonID in header: %s" % (header,),
           file=sys.stderr)
     assert False
-  writer = csv.writer(outport, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
   out_header = [field for field in header]  # copy
+  item_id_out_pos = item_id_pos
   if item_id_pos == None:
+    item_id_out_pos = len(out_header)
     out_header.append(item_id_col)
   if parent_usage_id_pos != None:
     out_header.append(parent_item_id_col)
-  writer.writerow(out_header)
-  map_count = 0
-  map_parent_count = 0
-  map_accepted_count = 0
-  self_parent = 0
-  for row in reader:
-    did_map = False
-    if map_count % 500000 == 0:
-      print("# map: loading map, row %s" % map_count, file=sys.stderr)
-    usage_id = row[usage_id_pos]
-    if not usage_id:
-      print("** map: No taxon id in column %s: %s" % (usage_id_pos, row,),
-            file=sys.stderr)
-      assert False
-    item_id = mappings.get(usage_id)
-    if item_id:
-      did_map = True
-      map_count += 1
-    # Deal with item id
-    if item_id_pos != None:
+
+  def generate():
+    map_count = 0
+    map_parent_count = 0
+    map_accepted_count = 0
+    self_parent = 0
+    count = 0
+    for row in reader:
+      count += 1
+      did_map = False
+      if map_count % 500000 == 0:
+        print("# map: loading map, row %s" % map_count, file=sys.stderr)
+      usage_id = row[usage_id_pos]
+      if not usage_id:
+        print("** map: No taxon id in column %s: %s" % (usage_id_pos, row,),
+              file=sys.stderr)
+        assert False
+      item_id = mappings.get(usage_id)
       if item_id:
-        have_item_id = row[item_id_pos]
-        if have_item_id:
-          if have_item_id != item_id:
-            print("map: Item id conflict for usage %s; replacing %s with %s" %
-                  (usage_id, have_item_id, item_id),
-                  file=sys.stderr)
-      elif row[item_id_pos]:
         did_map = True
-      row[item_id_pos] = item_id
-    else:
-      row.append(item_id)
-    if parent_usage_id_pos != None:
-      parent_usage_id = row[parent_usage_id_pos]
-      parent_item_id = mappings.get(parent_usage_id) if parent_usage_id else None
-      if parent_item_id and parent_item_id == item_id:
-        # Flush self-parent links!
-        self_parent += 1
-        continue
-      if parent_item_id:
-        map_parent_count += 1
-      row.append(parent_item_id)
-    if accepted_usage_id_pos != None and not item_id:
-      accepted_usage_id = row[accepted_usage_id_pos]
-      if accepted_usage_id and accepted_usage_id != usage_id:
-        accepted_item_id = mappings.get(accepted_usage_id)
-        if accepted_item_id:
+        map_count += 1
+      # Deal with item id
+      if item_id_pos != None:
+        if item_id:
+          have_item_id = row[item_id_pos]
+          if have_item_id:
+            if have_item_id != item_id:
+              print("map: Item id conflict for usage %s; replacing %s with %s" %
+                    (usage_id, have_item_id, item_id),
+                    file=sys.stderr)
+        elif row[item_id_pos]:
           did_map = True
-          map_accepted_count += 1
-          row[item_id_pos] = accepted_item_id
-    assert len(row) == len(out_header)
-    if not did_map:
-      print("** map: No mapping in row %s" % (row,),
-            file=sys.stderr)
-      continue
-    writer.writerow(row)
-  print("map: Mapped %s taxon ids, %s parents, %s accepteds" %
-        (map_count, map_parent_count, map_accepted_count),
-        file=sys.stderr)
-  if self_parent > 0:
-    print("map: Suppressed %s self-parent rows" % self_parent, file=sys.stderr)
+        row[item_id_pos] = item_id
+      else:
+        row.append(item_id)
+      if parent_usage_id_pos != None:
+        parent_usage_id = row[parent_usage_id_pos]
+        parent_item_id = mappings.get(parent_usage_id) if parent_usage_id else None
+        if parent_item_id and parent_item_id == item_id:
+          # Flush self-parent links!
+          self_parent += 1
+          continue
+        if parent_item_id:
+          map_parent_count += 1
+        row.append(parent_item_id)
+      if accepted_usage_id_pos != None and not item_id:
+        accepted_usage_id = row[accepted_usage_id_pos]
+        if accepted_usage_id and accepted_usage_id != usage_id:
+          accepted_item_id = mappings.get(accepted_usage_id)
+          if accepted_item_id:
+            did_map = True
+            map_accepted_count += 1
+            row[item_id_out_pos] = accepted_item_id
+      assert len(row) == len(out_header)
+      if not did_map:
+        print("** map: No mapping in row %s" % (row,),
+              file=sys.stderr)
+        continue
+      yield row
+    print("map: Mapped %s taxon ids, %s parents, %s accepteds" %
+          (map_count, map_parent_count, map_accepted_count),
+          file=sys.stderr)
+    if self_parent > 0:
+      print("map: Suppressed %s self-parent rows" % self_parent, file=sys.stderr)
+    metrics.count("rows", count)
+    metrics.count("mapped", map_count)
+    metrics.count("parents_mapped", map_parent_count)
+    metrics.count("accepteds_mapped", map_accepted_count)
+
+  return (out_header, generate())
 
 def read_mappings(mapfile):
   if not mapfile: return None
@@ -101,6 +122,267 @@ def read_mappings(mapfile):
         file=sys.stderr)
   return mappings
 
+# Same as apply_mappings, but for when the input and the mapping file
+# are both sorted by taxonID, in the order sortcsv.py sorts keys in
+# (keycodec; numbers numerically, ahead of other ids).  The mapping is
+# never loaded into memory; see map_rows_sorted.
+
+sort_key = keycodec.encode_value
+
+def apply_mappings_sorted(mapfile, inport, outport):
+  reader = csvio.reader(inport)
+  header = next(reader)
+  (out_header, rows) = map_rows_sorted(mapfile, header, reader)
+  writer = csvio.writer(outport)
+  writer.writerow(out_header)
+  with metrics.phase("map"):
+    writer.writerows(rows)
+
+# Merge join version of map_rows.
+#  1. Join the input rows with the mapping file to get each row's own
+#     item id.  Spill the rows to a temporary file, and collect
+#     requests for the parent and accepted usage ids, which can be
+#     anywhere in the mapping, in an external sort.
+#  2. Join the sorted requests with a second pass over the mapping
+#     file, and sort the answers back into row order.
+#  3. Read the spilled rows back alongside the answers, and hand each
+#     row, along with just the lookups it needs, to map_rows.
+# Memory use is bounded by the external sorts' budget.
+
+SORT_BUDGET = 32 * 1024 * 1024
+
+def map_rows_sorted(mapfile, header, reader):
+  usage_id_pos = windex(header, "taxonID")
+  parent_usage_id_pos = windex(header, "parentNameUsageID")
+  accepted_usage_id_pos = windex(header, "acceptedNameUsageID")
+  if usage_id_pos == None:
+    print("** map: No taxonID in header: %s" % (header,),
+          file=sys.stderr)
+    assert False
+
+  spill = tempfile.TemporaryFile("w+", newline="", buffering=csvio.BUFFER_SIZE)
+  spill_writer = csvio.writer(spill)
+  requests = extsort.Sorter(lambda request: sort_key(request[0]),
+                            budget=SORT_BUDGET)
+  count = 0
+  previous = None
+  with metrics.phase("join") as p:
+    for (row, item_id) in join(keyed_rows(reader, usage_id_pos),
+                               read_sorted_mappings(mapfile)):
+      usage_id = row[usage_id_pos]
+      key = sort_key(usage_id)
+      if previous != None and not key > previous[0]:
+        print("** map: Input not sorted by taxonID: %s after %s" %
+              (usage_id, previous[1]),
+              file=sys.stderr)
+        assert False
+      previous = (key, usage_id)
+      spill_writer.writerow([item_id or ""] + row)
+      if parent_usage_id_pos != None and row[parent_usage_id_pos]:
+        requests.add([row[parent_usage_id_pos], str(count)])
+      if accepted_usage_id_pos != None and row[accepted_usage_id_pos]:
+        requests.add([row[accepted_usage_id_pos], str(count)])
+      count += 1
+    p.rows = count
+  print("map: %s rows joined, resolving parents and accepteds" % count,
+        file=sys.stderr)
+
+  answers = extsort.Sorter(lambda answer: int(answer[0]), budget=SORT_BUDGET)
+  with metrics.phase("resolve"):
+    for ([other_id, n], item_id) in join(((sort_key(request[0]), request)
+                                           for request in requests.finish()),
+                                          read_sorted_mappings(mapfile)):
+      if item_id:
+        answers.add([n, other_id, item_id])
+
+  lookups = RowLookups()
+  def spilled_rows():
+    spill.seek(0)
+    answer_rows = answers.finish()
+    answer = next(answer_rows, None)
+    n = 0
+    for row in csv.reader(spill):
+      item_id = row[0]
+      row = row[1:]
+      found = {row[usage_id_pos]: item_id} if item_id else {}
+      while answer != None and int(answer[0]) == n:
+        found[answer[1]] = answer[2]
+        answer = next(answer_rows, None)
+      lookups.current = found
+      yield row
+      n += 1
+    spill.close()
+  return map_rows(lookups, header, spilled_rows())
+
+# Stands in for the mappings dict in map_rows: answers lookups for the
+# row that map_rows is currently working on.  map_rows finishes with a
+# row before asking for the next one, so this is always up to date.
+
+class RowLookups:
+  def __init__(self):
+    self.current = {}
+  def get(self, usage_id, default=None):
+    return self.current.get(usage_id, default)
+
+def keyed_rows(reader, pos):
+  for row in reader:
+    yield (sort_key(row[pos]), row)
+
+# Yields (key, item_id), where key is sort_key of the usage id, from a
+# mapping file sorted by usage id.  When a usage id occurs more than
+# once the last one wins, as in read_mappings.
+
+def read_sorted_mappings(mapfile):
+  with open(mapfile, "r") as infile:
+    reader = csv.reader(infile)
+    next(reader)
+    have = None
+    previous = None
+    for [usage_id, item_id] in reader:
+      key = sort_key(usage_id)
+      if have != None:
+        if key < have[0]:
+          print("** map: Mapping file not sorted by usage id: %s after %s" %
+                (usage_id, previous),
+                file=sys.stderr)
+          assert False
+        if key != have[0]:
+          yield have
+      have = (key, item_id)
+      previous = usage_id
+    if have != None:
+      yield have
+
+# Merge join.  keyed is a sequence of (key, payload) in nondecreasing
+# key order, and pairs a sequence of (key, value) in increasing key
+# order.  Yields (payload, value) for each element of keyed, with None
+# as the value if the key has no pair.
+
+def join(keyed, pairs):
+  pair = next(pairs, None)
+  for (key, payload) in keyed:
+    while pair != None and pair[0] < key:
+      pair = next(pairs, None)
+    if pair != None and pair[0] == key:
+      yield (payload, pair[1])
+    else:
+      yield (payload, None)
+
+# Open a mapping for lookup: a dict read from mapfile, or if indexed is
+# true, a MappingIndex.
+
+def open_mappings(mapfile, indexed=False):
+  if not mapfile: return None
+  if indexed:
+    return MappingIndex(mapfile)
+  return read_mappings(mapfile)
+
+# Persistent taxonID -> item id mapping, for maps too big to load into a
+# dict on every run.  The CSV file is compiled into an sqlite database
+# next to it (mapfile + ".sqlite"), which is rebuilt only when the CSV
+# file's size or modification time changes.  Lookups go to the
+# database, so memory use does not depend on the size of the map.
+# Assignments (as done by hierarchy.py) are kept in memory on top of it.
+
+INDEX_SUFFIX = ".sqlite"
+CACHE_SIZE = 100000
+
+class MappingIndex:
+  def __init__(self, mapfile):
+    self.mapfile = mapfile
+    self.path = mapfile + INDEX_SUFFIX
+    self.added = {}
+    stamp = source_stamp(mapfile)
+    if index_stamp(self.path) != stamp:
+      build_index(mapfile, self.path, stamp)
+    self.db = sqlite3.connect(read_only_uri(self.path), uri=True)
+    cursor = self.db.cursor()
+    (self.count,) = cursor.execute("SELECT COUNT(*) FROM mapping").fetchone()
+    print("map: %s mappings in %s" % (self.count, self.path),
+          file=sys.stderr)
+
+    # Parent ids repeat a lot, so keep recent lookups
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def lookup(usage_id):
+      found = cursor.execute("SELECT item_id FROM mapping WHERE usage_id = ?",
+                             (usage_id,)).fetchone()
+      return found[0] if found else None
+    self.lookup = lookup
+
+  def get(self, usage_id, default=None):
+    item_id = self.added.get(usage_id)
+    if item_id != None: return item_id
+    item_id = self.lookup(usage_id)
+    if item_id == None: return default
+    return item_id
+
+  def __setitem__(self, usage_id, item_id):
+    self.added[usage_id] = item_id
+
+  def __getitem__(self, usage_id):
+    item_id = self.get(usage_id)
+    if item_id == None: raise KeyError(usage_id)
+    return item_id
+
+  def __contains__(self, usage_id):
+    return self.get(usage_id) != None
+
+  def __len__(self):
+    return self.count + len(self.added)
+
+  def close(self):
+    self.db.close()
+
+def source_stamp(mapfile):
+  st = os.stat(mapfile)
+  return "%s %s" % (st.st_size, st.st_mtime_ns)
+
+# '#', '?' and '%' in a file name would otherwise be read as URI syntax
+
+def read_only_uri(path):
+  return pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+
+def index_stamp(path):
+  if not os.path.exists(path): return None
+  try:
+    db = sqlite3.connect(read_only_uri(path), uri=True)
+    try:
+      found = db.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+    finally:
+      db.close()
+  except sqlite3.Error:
+    return None
+  return found[0] if found else None
+
+def build_index(mapfile, path, stamp):
+  print("map: Building index %s from %s" % (path, mapfile), file=sys.stderr)
+  temp = path + ".new"
+  if os.path.exists(temp): os.remove(temp)
+  db = sqlite3.connect(temp)
+  db.execute("PRAGMA journal_mode = OFF")
+  db.execute("PRAGMA synchronous = OFF")
+  db.execute("CREATE TABLE mapping (usage_id TEXT PRIMARY KEY, item_id TEXT) WITHOUT ROWID")
+  db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+  count = 0
+  with open(mapfile, "r") as infile:
+    reader = csv.reader(infile)
+    next(reader)
+    batch = []
+    for [usage_id, item_id] in reader:
+      batch.append((usage_id, item_id))
+      if len(batch) >= 100000:
+        # Later rows win, as they do when reading into a dict
+        db.executemany("INSERT OR REPLACE INTO mapping VALUES (?, ?)", batch)
+        count += len(batch)
+        batch = []
+        if count % 1000000 == 0:
+          print("map: indexed %s" % count, file=sys.stderr)
+    db.executemany("INSERT OR REPLACE INTO mapping VALUES (?, ?)", batch)
+  db.execute("INSERT INTO meta VALUES ('source', ?)", (stamp,))
+  db.commit()
+  db.close()
+  os.replace(temp, path)
+
 def windex(header, fieldname):
   if fieldname in header:
     return header.index(fieldname)
@@ -114,5 +396,17 @@ if __name__ == '__main__':
     """)
   parser.add_argument('--mapping',
                       help='name of file where taxonID to item id mapping is stored')
+  parser.add_argument('--index', action='store_true',
+                      help='look up through an on-disk index of the mapping file, built if needed')
+  parser.add_argument('--sorted', action='store_true',
+                      help='input and mapping file are both sorted by taxonID, in sortcsv.py order (ids made of digits numerically, ahead of the others); merge them instead of loading the mapping')
+  metrics.add_argument(parser)
   args=parser.parse_args()
-  apply_mappings(read_mappings(args.mapping), sys.stdin, sys.stdout)
+  with csvio.stdout() as outport:
+    if args.sorted:
+      apply_mappings_sorted(args.mapping, sys.stdin, outport)
+    else:
+      with metrics.phase("mappings"):
+        mappings = open_mappings(args.mapping, args.index)
+      apply_mappings(mappings, sys.stdin, outport)
+  metrics.report("idmap", args.metrics_json)
@@ -0,0 +1,45 @@
+# Primary keys as bytes, so that tools that sort or merge on a key all
+# agree on the order, and keys compare as fast as bytes do.
+
+# The order is the numeric-aware one that prepare.py and olddiff.py
+# have always used (mint): a value made only of digits sorts as a
+# number, ahead of any other value, and otherwise values sort as
+# strings.  encode_value(v1) < encode_value(v2) exactly when
+# mint(v1) < mint(v2), where
+#   mint(v) = (int(v), v) if v.isdigit() else (1000000000, v)
+# A value is encoded as
+#   number: one byte giving its length n, then n bytes, big-endian
+#   string: UTF-8, with each 0 byte written as 0 255, then 0 0
+# Both parts are self-delimiting, so a composite key is just its
+# values' encodings concatenated, and compares like a tuple would.
+
+NOT_NUMBER = 1000000000
+
+def number_bytes(n):
+  m = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+  return bytes((len(m),)) + m
+
+NOT_NUMBER_BYTES = number_bytes(NOT_NUMBER)
+
+def encode_value(val):
+  if val and val.isdigit():
+    prefix = number_bytes(int(val))
+  else:
+    prefix = NOT_NUMBER_BYTES
+  text = val.encode('utf-8')
+  if b"\0" in text:
+    text = text.replace(b"\0", b"\0\xff")
+  return prefix + text + b"\0\0"
+
+def encode_key(values):
+  return b"".join(encode_value(val) for val in values)
+
+# Returns a function from a row to the encoded key made from the values
+# at the given positions.
+
+def key_function(positions):
+  if len(positions) == 1:
+    (pos,) = positions
+    return lambda row: encode_value(row[pos])
+  positions = tuple(positions)
+  return lambda row: b"".join(encode_value(row[pos]) for pos in positions)
@@ -0,0 +1,86 @@
+# Where a tool's time and memory go, for the tools' --metrics-json.
+
+# A tool marks its phases with
+#   with metrics.phase("read") as p:
+#     ...
+#     p.rows += 1
+# and counts things with metrics.count("rows", n).  Phases may nest or
+# repeat; each is recorded separately, with when it started (seconds
+# since the tool started), how long it took, how many rows it handled
+# if the tool says, and the peak resident set size so far.  Streaming
+# tools interleave reading and writing, so their phases are coarser
+# than a batch tool's.
+
+# report() writes all that as one line of JSON, appending it to a file
+# so that runs accumulate and can be compared across releases.
+
+import sys, time, json, resource
+
+_start = time.perf_counter()
+_phases = []
+_counts = {}
+
+class Phase:
+  def __init__(self, name):
+    self.name = name
+    self.rows = 0
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.seconds = time.perf_counter() - self.start
+    self.max_rss = max_rss_mb()
+    _phases.append(self)
+    return False
+
+  def as_json(self):
+    record = {"name": self.name,
+              "start": round(self.start - _start, 4),
+              "seconds": round(self.seconds, 4),
+              "max_rss_mb": round(self.max_rss, 1)}
+    if self.rows:
+      record["rows"] = self.rows
+      record["rows_per_second"] = rate(self.rows, self.seconds)
+    return record
+
+def phase(name):
+  return Phase(name)
+
+def count(name, n=1):
+  _counts[name] = _counts.get(name, 0) + n
+
+# Peak resident set size in megabytes (ru_maxrss is in kilobytes on
+# Linux), of this process or of its largest child
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+  return resource.getrusage(who).ru_maxrss / 1024
+
+def rate(n, seconds):
+  return round(n / seconds, 1) if seconds > 0 else None
+
+def add_argument(parser):
+  parser.add_argument('--metrics-json', default=None, metavar='PATH',
+                      help='append phase timings, row counts and peak memory for this run to PATH, as a line of JSON (- for standard error)')
+
+def report(tool, path):
+  if path == None: return
+  seconds = time.perf_counter() - _start
+  record = {"tool": tool,
+            "argv": sys.argv[1:],
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "seconds": round(seconds, 4),
+            "max_rss_mb": round(max_rss_mb(), 1),
+            "children_max_rss_mb": round(max_rss_mb(resource.RUSAGE_CHILDREN), 1),
+            "counts": _counts,
+            "phases": [p.as_json()
+                       for p in sorted(_phases, key=lambda p: p.start)]}
+  if "rows" in _counts:
+    record["rows_per_second"] = rate(_counts["rows"], seconds)
+  line = json.dumps(record)
+  if path == "-":
+    print(line, file=sys.stderr)
+  else:
+    with open(path, "a") as outfile:
+      print(line, file=outfile)
@@ -6,6 +6,7 @@
 # Records are matched between the sources via their primary keys.
 
 import sys, csv, argparse
+import keycodec
 
 def prepare_diff_report(pk_spec, path2, inport1, outport):
   pk_fields = pk_spec.split(",")
@@ -86,15 +87,9 @@ def changefoo(v1, v2):
   else:
     return "%s→%s" % (v1 or "", v2 or "")
 
-# Compare prepare.py
+# Numeric-aware key, as bytes (see keycodec.py).  Compare prepare.py
 def primary_key(row1, pk_positions1):
-  return tuple(mint(row1[pos]) for pos in pk_positions1)
-
-def mint(val):
-  if val and val.isdigit():
-    return (int(val), val)
-  else:
-    return (1000000000, val)
+  return keycodec.encode_key(row1[pos] for pos in pk_positions1)
 
 def row_diff(row1, row2, column_map):
   if not isinstance(row1, list):
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Runs start -> map -> project in a single process, equivalent to
+#   start.py --input X --pk P | idmap.py --mapping M | project.py --keep K
+# but passing rows from stage to stage as lists instead of writing and
+# re-parsing CSV at each boundary.
+# (The names.py stage used by lib/hierarchy.rb is not part of pylib,
+# so it is not included.)
+
+import sys, csv, time, argparse
+from util import csv_parameters
+import start, idmap, project
+
+# Generator that passes rows through, adding the time spent getting
+# each row from upstream (inclusive of all earlier stages) to
+# times[name].
+
+def timed(rows, name, times):
+  times[name] = 0.0
+  rows = iter(rows)
+  clock = time.perf_counter
+  while True:
+    t = clock()
+    try:
+      row = next(rows)
+    except StopIteration:
+      times[name] += clock() - t
+      return
+    times[name] += clock() - t
+    yield row
+
+def run_pipeline(inport, params, outport, pk_col, cleanp, mappings, keep, drop):
+  times = {}
+  stages = ["read"]
+  (d, q, g) = params
+  reader = csv.reader(inport, delimiter=d, quotechar=q, quoting=g)
+  header = next(reader)
+  rows = timed(reader, "read", times)
+
+  (header, rows) = start.start_rows(header, rows, pk_col, cleanp)
+  rows = timed(rows, "start", times)
+  stages.append("start")
+  if mappings != None:
+    (header, rows) = idmap.map_rows(mappings, header, rows)
+    rows = timed(rows, "map", times)
+    stages.append("map")
+  if keep or drop:
+    (header, rows) = project.project_rows(keep, drop, header, rows)
+    rows = timed(rows, "project", times)
+    stages.append("project")
+
+  writer = csv.writer(outport)
+  writer.writerow(header)
+  count = 0
+  write_time = 0.0
+  clock = time.perf_counter
+  start_time = clock()
+  for row in rows:
+    t = clock()
+    writer.writerow(row)
+    write_time += clock() - t
+    count += 1
+  total = clock() - start_time
+
+  # Each stage's time includes the stages before it; subtract
+  print("# pipeline: %s rows in %.2f s" % (count, total), file=sys.stderr)
+  upstream = 0.0
+  for stage in stages:
+    print("# pipeline:   %-8s %8.2f s" % (stage, times[stage] - upstream),
+          file=sys.stderr)
+    upstream = times[stage]
+  print("# pipeline:   %-8s %8.2f s" % ("write", write_time), file=sys.stderr)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="""
+    Normalize (as start.py does), map usage ids to item ids (as idmap.py
+    does), and select columns (as project.py does), in one process.
+    CSV rows are written to standard output.  Time spent in each stage
+    is reported at the end.
+    """)
+  parser.add_argument('--input', default=None,
+                      help='name of input file.  TSV assumed unless name contains ".csv"')
+  parser.add_argument('--pk', default=None,
+                      help='name of column containing primary key')
+  parser.add_argument('--clean', dest='clean', action='store_true',
+                      help='clean up scientificName and canonicalName a little bit')
+  parser.add_argument('--no-clean', dest='clean', action='store_false')
+  parser.set_defaults(clean=True)
+  parser.add_argument('--mapping',
+                      help='name of file where taxonID to item id mapping is stored')
+  parser.add_argument('--index', action='store_true',
+                      help='look up through an on-disk index of the mapping file, built if needed')
+  parser.add_argument('--keep',
+                      help="a,b,c where a,b,c are columns to keep (removing all others)")
+  parser.add_argument('--drop',
+                      help="a,b,c where a,b,c are columns to drop (keeping all others)")
+  args=parser.parse_args()
+  params = csv_parameters(args.input)
+  mappings = idmap.open_mappings(args.mapping, args.index)
+  if args.input == None:
+    run_pipeline(sys.stdin, params, sys.stdout, args.pk, args.clean,
+                 mappings, args.keep, args.drop)
+  else:
+    with open(args.input, "r") as inport:
+      run_pipeline(inport, params, sys.stdout, args.pk, args.clean,
+                   mappings, args.keep, args.drop)
@@ -0,0 +1,184 @@
+# Checking that primary keys are unique, for start.py.
+
+# Keeping every key in a dict (the "dict" method) finds a duplicate
+# as soon as it is seen, but takes a lot of memory on big inputs.  The
+# other methods use less memory and report duplicates at the end
+# (finish), after all the keys have been added:
+#  - "sort": keys are sorted with extsort, spilling to disk as needed,
+#    and duplicates are adjacent in the sorted keys
+#  - "hash": a 64-bit hash of each key is kept in a compact array
+#  - "bloom": keys are run through a Bloom filter
+# For "hash" and "bloom" a hit might be a false positive, so the keys
+# are also written to a temporary file, and any suspected keys are
+# confirmed by reading it back.  All methods are exact.
+
+# The Bloom filter is sized for the number of keys expected (given, or
+# estimated from the size of the input by estimate_keys), since past
+# that its false positive rate climbs quickly.  It remembers the
+# hashes of suspected keys, not the keys, so even a filter that turns
+# out too small takes no more memory than "hash" does.
+
+import sys, os, csv, stat, tempfile
+from array import array
+from bisect import bisect_left
+import extsort
+
+METHODS = ["dict", "sort", "hash", "bloom"]
+
+SORT_BUDGET = 32 * 1024 * 1024
+HASH_BUCKETS = 4096
+BLOOM_KEYS = 10000000      # expected number of keys, if not known
+BLOOM_MIN_KEYS = 100000
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+REPORT_LIMIT = 10
+MIN_ROW_BYTES = 32         # rows are rarely shorter than this
+
+# expected_keys, if given, is about how many keys will be added
+
+def make_checker(method, pk_col, expected_keys=None):
+  if method == "dict": return DictCheck(pk_col)
+  if method == "sort": return SortCheck(pk_col)
+  if method == "hash": return HashCheck(pk_col)
+  if method == "bloom": return BloomCheck(pk_col, expected_keys)
+  print("** pkcheck: Unknown method %s" % method, file=sys.stderr)
+  assert False
+
+# Upper estimate of the number of rows in the file open on port, from
+# its size, or None if it isn't a regular file (a pipe, say)
+
+def estimate_keys(port):
+  try:
+    st = os.fstat(port.fileno())
+  except (AttributeError, OSError, ValueError):
+    return None
+  if not stat.S_ISREG(st.st_mode): return None
+  return st.st_size // MIN_ROW_BYTES
+
+def complain(pk_col, pk):
+  print("%s is not a good primary key column.  Two or more rows with %s = %s\n" %
+        (pk_col, pk_col, pk),
+        file=sys.stderr)
+
+# Complain about the duplicate keys found by a deferred method, then fail
+def fail_if_duplicates(pk_col, duplicates):
+  if duplicates:
+    for pk in duplicates[0:REPORT_LIMIT]:
+      complain(pk_col, pk)
+    if len(duplicates) > REPORT_LIMIT:
+      print("pkcheck: ... and %s more" % (len(duplicates) - REPORT_LIMIT),
+            file=sys.stderr)
+    assert not duplicates
+
+class DictCheck:
+  def __init__(self, pk_col):
+    self.pk_col = pk_col
+    self.seen = {}
+
+  def add(self, pk):
+    if pk in self.seen:
+      complain(self.pk_col, pk)
+      assert not (pk in self.seen)
+    self.seen[pk] = True
+
+  def finish(self):
+    self.seen = None
+
+class SortCheck:
+  def __init__(self, pk_col):
+    self.pk_col = pk_col
+    self.sorter = extsort.Sorter(lambda row: row[0], SORT_BUDGET)
+
+  def add(self, pk):
+    self.sorter.add([pk])
+
+  def finish(self):
+    duplicates = []
+    previous = None
+    for [pk] in self.sorter.finish():
+      if pk == previous and (not duplicates or duplicates[-1] != pk):
+        duplicates.append(pk)
+      previous = pk
+    self.sorter = None
+    fail_if_duplicates(self.pk_col, duplicates)
+
+# Base for the methods that confirm suspects by re-reading the keys
+
+class SpillCheck:
+  def __init__(self, pk_col):
+    self.pk_col = pk_col
+    self.spill = tempfile.TemporaryFile("w+", newline="")
+    self.writer = csv.writer(self.spill)
+
+  def add(self, pk):
+    self.writer.writerow([pk])
+
+  # Of the keys satisfying suspect, those that occur more than once
+  def confirm(self, suspect):
+    counts = {}
+    self.spill.seek(0)
+    for [pk] in csv.reader(self.spill):
+      if suspect(pk):
+        counts[pk] = counts.get(pk, 0) + 1
+    self.spill.close()
+    self.spill = self.writer = None
+    return [pk for (pk, count) in counts.items() if count > 1]
+
+class HashCheck(SpillCheck):
+  def __init__(self, pk_col):
+    super().__init__(pk_col)
+    self.buckets = [array('Q') for k in range(HASH_BUCKETS)]
+
+  def add(self, pk):
+    super().add(pk)
+    h = hash(pk) & 0xFFFFFFFFFFFFFFFF
+    self.buckets[h % HASH_BUCKETS].append(h)
+
+  def finish(self):
+    suspects = set()
+    for k in range(len(self.buckets)):
+      bucket = sorted(self.buckets[k])
+      self.buckets[k] = None
+      for i in range(1, len(bucket)):
+        if bucket[i] == bucket[i-1]:
+          suspects.add(bucket[i])
+    self.buckets = None
+    duplicates = []
+    if suspects:
+      duplicates = self.confirm(
+        lambda pk: (hash(pk) & 0xFFFFFFFFFFFFFFFF) in suspects)
+    fail_if_duplicates(self.pk_col, duplicates)
+
+class BloomCheck(SpillCheck):
+  def __init__(self, pk_col, expected_keys=None):
+    super().__init__(pk_col)
+    if expected_keys == None: expected_keys = BLOOM_KEYS
+    self.size = max(expected_keys, BLOOM_MIN_KEYS) * BLOOM_BITS_PER_KEY
+    self.bits = bytearray((self.size + 7) // 8)
+    self.suspects = array('Q')     # hashes of keys the filter had seen
+
+  def add(self, pk):
+    super().add(pk)
+    h = hash(pk) & 0xFFFFFFFFFFFFFFFF
+    (h1, h2) = (h & 0xFFFFFFFF, (h >> 32) | 1)
+    (bits, size) = (self.bits, self.size)
+    present = True
+    for k in range(BLOOM_HASHES):
+      i = (h1 + k * h2) % size
+      mask = 1 << (i & 7)
+      if not bits[i >> 3] & mask:
+        present = False
+        bits[i >> 3] |= mask
+    if present:
+      self.suspects.append(h)
+
+  def finish(self):
+    self.bits = None
+    suspects = array('Q', sorted(set(self.suspects)))
+    self.suspects = None
+    def suspect(pk):
+      h = hash(pk) & 0xFFFFFFFFFFFFFFFF
+      i = bisect_left(suspects, h)
+      return i < len(suspects) and suspects[i] == h
+    duplicates = self.confirm(suspect) if suspects else []
+    fail_if_duplicates(self.pk_col, duplicates)
@@ -3,11 +3,14 @@
 # Detect duplicates and sort according to some primary key.
 
 import sys, csv, argparse
+import extsort, keycodec, metrics
 
-def prepare(pk_spec, inport, outport):
+# Reads the header row; returns (header, positions of the primary key
+# fields, position of canonicalName, position of scientificName)
+
+def read_header(pk_spec, reader):
   pk_fields = pk_spec.split(",")
   print("# prepare: Primary key fields = %s" % pk_fields, file=sys.stderr)
-  reader = csv.reader(inport)
   header = next(reader)
   for field in pk_fields:
     if windex(header, field) == None:
@@ -18,6 +21,11 @@ def prepare(pk_spec, inport, outport):
   pk_positions = [windex(header, field) for field in pk_fields]
   can_pos = windex(header, "canonicalName")
   sci_pos = windex(header, "scientificName")
+  return (header, pk_positions, can_pos, sci_pos)
+
+def prepare(pk_spec, inport, outport):
+  reader = csv.reader(inport)
+  (header, pk_positions, can_pos, sci_pos) = read_header(pk_spec, reader)
   merged = {}
   conflicts = {}
   scinames = {}
@@ -26,50 +34,127 @@ def prepare(pk_spec, inport, outport):
   count = 0
   writer = csv.writer(outport)
   writer.writerow(header)
-  for row in reader:
-    pk = primary_key(row, pk_positions)
-    if not any(pk):
-      print("# prepare: Bad key, row = %s" % (row,),
-            file=sys.stderr)
-      assert False
-    have_row = merged.get(pk)
-    if have_row:
-      merged[pk] = merge(have_row, row)
-      conflicts[pk] = True
-      merges += 1
-      if merges < 10:
-        print("# prepare: Merge <- %s" % have_row, file=sys.stderr)
-    else:
-      merged[pk] = row
-    if sci_pos != None:
-      name = row[sci_pos]
-      if not name:
+  with metrics.phase("read") as p:
+    for row in reader:
+      pk = primary_key(row, pk_positions)
+      if not pk:
+        print("# prepare: Bad key, row = %s" % (row,),
+              file=sys.stderr)
+        assert False
+      have_row = merged.get(pk)
+      if have_row:
+        merged[pk] = merge(have_row, row)
+        conflicts[pk] = True
+        merges += 1
+        if merges < 10:
+          print("# prepare: Merge <- %s" % have_row, file=sys.stderr)
+      else:
+        merged[pk] = row
+      if sci_pos != None:
+        name = row[sci_pos]
+        if not name:
+          name = row[can_pos]
+      else:
         name = row[can_pos]
-    else:
-      name = row[can_pos]
-    if name in scinames:
-      print("# ambiguous scientific name: %s" % name)
-    scinames[name] = row
-    if count % 500000 == 0:
-      print("# prepare: %s" % count, file=sys.stderr)
-    count += 1
-  s = sorted(merged.keys())
+      if name in scinames and not name in ambiguous_scinames:
+        print("# ambiguous scientific name: %s" % name, file=sys.stderr)
+        ambiguous_scinames[name] = True
+      scinames[name] = row
+      if count % 500000 == 0:
+        print("# prepare: %s" % count, file=sys.stderr)
+      count += 1
+    p.rows = count
+  with metrics.phase("sort"):
+    s = sorted(merged.keys())
   print("# prepare: sorted %s rows" % len(s), file=sys.stderr)
-  for key in s:
-    writer.writerow(merged[key])
+  with metrics.phase("write") as p:
+    for key in s:
+      writer.writerow(merged[key])
+    p.rows = len(s)
+  metrics.count("rows", count)
+  metrics.count("merges", merges)
   print("prepare: %s rows resulting from merges" % len(conflicts), file=sys.stderr)
   print("prepare: %s ambiguous names" % len(ambiguous_scinames), file=sys.stderr)
 
-# Compare diff.py
-def primary_key(row1, pk_positions1):
-  # not so good I think.
-  return tuple(mint(row1[pos]) for pos in pk_positions1)
+# Same as prepare, but with memory bounded by the given budget (bytes).
+# Rows are sorted externally on the primary key, and rows with equal
+# keys, which come out of the sort adjacent and in input order, are
+# merged as they go by.  Names are sorted separately so that ambiguous
+# names can be found without holding them all in memory.
 
-def mint(val):
-  if val and val.isdigit():
-    return (int(val), val)
-  else:
-    return (1000000000, val)
+def prepare_streaming(pk_spec, inport, outport, memory):
+  reader = csv.reader(inport)
+  (header, pk_positions, can_pos, sci_pos) = read_header(pk_spec, reader)
+  row_key = lambda row: primary_key(row, pk_positions)
+  rows = extsort.Sorter(row_key, budget=memory)
+  names = extsort.Sorter(lambda name_row: name_row[0], budget=memory // 4)
+  count = 0
+  with metrics.phase("read") as p:
+    for row in reader:
+      if sci_pos != None:
+        name = row[sci_pos]
+        if not name:
+          name = row[can_pos]
+      else:
+        name = row[can_pos]
+      rows.add(row)
+      names.add([name])
+      if count % 500000 == 0:
+        print("# prepare: %s" % count, file=sys.stderr)
+      count += 1
+    p.rows = count
+
+  writer = csv.writer(outport)
+  writer.writerow(header)
+  conflicts = 0
+  merges = 0
+  written = 0
+  have_row = None
+  have_pk = None
+  merging = False
+  with metrics.phase("merge") as p:
+    for row in rows.finish():
+      pk = row_key(row)
+      if have_row != None and pk == have_pk:
+        if not merging:
+          conflicts += 1
+          merging = True
+        merges += 1
+        if merges < 10:
+          print("# prepare: Merge <- %s" % have_row, file=sys.stderr)
+        have_row = merge(have_row, row)
+      else:
+        if have_row != None:
+          writer.writerow(have_row)
+          written += 1
+        (have_row, have_pk) = (row, pk)
+        merging = False
+    if have_row != None:
+      writer.writerow(have_row)
+      written += 1
+    p.rows = written
+  print("# prepare: sorted %s rows" % written, file=sys.stderr)
+
+  ambiguous = 0
+  previous = None
+  with metrics.phase("names"):
+    for [name] in names.finish():
+      if name == previous:
+        if not reported:
+          print("# ambiguous scientific name: %s" % name, file=sys.stderr)
+          ambiguous += 1
+          reported = True
+      else:
+        previous = name
+        reported = False
+  print("prepare: %s rows resulting from merges" % conflicts, file=sys.stderr)
+  print("prepare: %s ambiguous names" % ambiguous, file=sys.stderr)
+  metrics.count("rows", count)
+  metrics.count("merges", merges)
+
+# Numeric-aware key, as bytes (see keycodec.py).  Compare olddiff.py
+def primary_key(row1, pk_positions1):
+  return keycodec.encode_key(row1[pos] for pos in pk_positions1)
 
 def merge(row1, row2):
   return [merge_values(x, y) for (x, y) in zip(row1, row2)]
@@ -99,5 +184,13 @@ if __name__ == '__main__':
     """)
   parser.add_argument('--key',
                       help="names 'a,b,c' for columns that together form the sort key")
+  parser.add_argument('--memory', type=float, default=None,
+                      help='memory budget in megabytes; if given, sort externally')
+  metrics.add_argument(parser)
   args=parser.parse_args()
-  prepare(args.key, sys.stdin, sys.stdout)
+  if args.memory:
+    prepare_streaming(args.key, sys.stdin, sys.stdout,
+                      int(args.memory * 1024 * 1024))
+  else:
+    prepare(args.key, sys.stdin, sys.stdout)
+  metrics.report("prepare", args.metrics_json)
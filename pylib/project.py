@@ -2,11 +2,21 @@
 
 # Remove some columns
 
-import sys, csv, argparse
+import sys, argparse
+import csvio
 
 def project(keep, drop, inport, outport):
-  reader = csv.reader(inport)
+  reader = csvio.reader(inport)
   header = next(reader)
+  (keepers, rows) = project_rows(keep, drop, header, reader)
+  writer = csvio.writer(outport)
+  writer.writerow(keepers)
+  writer.writerows(rows)
+
+# Returns (out_header, out_rows) where out_rows is a generator of the
+# projected rows.  Can be used as a stage in an in-process pipeline.
+
+def project_rows(keep, drop, header, reader):
   keepers = header
   if keep:
     keepers = keep.split(",")
@@ -22,11 +32,13 @@ def project(keep, drop, inport, outport):
   keep_positions = [header.index(keeper) for keeper in keepers]
   print("# project: Keeping %s" % (keepers,), file=sys.stderr)
   print("# project: Keeping %s" % (keep_positions,), file=sys.stderr)
-  writer = csv.writer(outport, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-  writer.writerow(keepers)
-  for row in reader:
-    assert len(row) == len(header)
-    writer.writerow([row[position] for position in keep_positions])
+
+  def generate():
+    for row in reader:
+      assert len(row) == len(header)
+      yield [row[position] for position in keep_positions]
+
+  return (keepers, generate())
 
 if __name__ == '__main__':
   specified_columns = sys.argv[1]
@@ -38,4 +50,5 @@ if __name__ == '__main__':
   parser.add_argument('--drop',
                       help="a,b,c where a,b,c are columns to drop (keeping all others)")
   args=parser.parse_args()
-  project(args.keep, args.drop, sys.stdin, sys.stdout)
+  with csvio.stdout() as outport:
+    project(args.keep, args.drop, sys.stdin, outport)
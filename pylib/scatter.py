@@ -3,8 +3,9 @@
 # Turns a single csv with a 'mode' column into a set of csvs, one for
 # each value found in the 'mode' column.
 
-import sys, os, csv, argparse, pathlib
+import sys, os, argparse, pathlib
 from util import windex
+import csvio
 
 mode_column = "mode"
 
@@ -13,7 +14,7 @@ def scatter(inport, dest):
   import pathlib
   pathlib.Path(dest).mkdir(parents=True, exist_ok=True)
 
-  reader = csv.reader(inport)
+  reader = csvio.reader(inport)
   header = next(reader)
 
   files = {}
@@ -31,9 +32,9 @@ def scatter(inport, dest):
     del row[mode_pos]
     if not mode in writers:
       fname = os.path.join(dest, mode + ".csv")
-      file = open(fname + ".new", "w")
+      file = csvio.open_output(fname + ".new")
       files[mode] = file
-      writers[mode] = csv.writer(file)
+      writers[mode] = csvio.writer(file)
       writers[mode].writerow(subheader)
       counts[mode] = 0
     writer = writers[mode]
@@ -0,0 +1,122 @@
+# Batched match scoring for diff.py.
+
+# Gives the same scores as diff.compute_score, but works on integer
+# codes instead of strings.  The values of each weighted column are
+# interned once per file, using one table per column shared by both
+# files, so that equal values get equal codes.  MISSING is always 0.
+# All of the candidates for a row in file 1 are then scored in one
+# operation: with NumPy if it is installed, otherwise in a plain loop
+# over the codes.
+
+import sys
+from util import MISSING
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+class Scorer:
+
+  # weights is parallel to header2, as returned by diff.get_weights
+
+  def __init__(self, all_rows1, all_rows2, corr_12, weights):
+    columns = [j for j in range(len(weights)) if weights[j] != 0]
+    v = corr_12.v
+    tables = [{MISSING: 0} for j in columns]
+
+    def intern(row, positions):
+      codes = []
+      for (table, pos) in zip(tables, positions):
+        if pos == None:
+          codes.append(0)
+        else:
+          value = row[pos]
+          code = table.get(value)
+          if code == None:
+            code = len(table)
+            table[value] = code
+          codes.append(code)
+      return codes
+
+    positions1 = [v[j] for j in columns]
+    self.index1 = {}
+    codes1 = []
+    for (key1, row1) in all_rows1.items():
+      self.index1[key1] = len(codes1)
+      codes1.append(intern(row1, positions1))
+    self.index2 = {}
+    codes2 = []
+    for (key2, row2) in all_rows2.items():
+      self.index2[key2] = len(codes2)
+      codes2.append(intern(row2, columns))
+    print("Interned %s columns, %s distinct values" %
+          (len(columns), sum(len(table) for table in tables)),
+          file=sys.stderr)
+    tables = None
+
+    self.weights = [weights[j] for j in columns]
+    if numpy != None:
+      self.codes1 = numpy.array(codes1, dtype=numpy.int32).reshape(-1, len(columns))
+      self.codes2 = numpy.array(codes2, dtype=numpy.int32).reshape(-1, len(columns))
+      self.weight_vector = numpy.array(self.weights, dtype=numpy.int64)
+    else:
+      self.codes1 = [tuple(codes) for codes in codes1]
+      self.codes2 = [tuple(codes) for codes in codes2]
+
+  # Scores every candidate for a block of rows in file 1 in one
+  # operation.  keys1 are the primary keys of the rows and props_list
+  # their properties (parallel lists).  The result is parallel to
+  # keys1; each element is a list parallel to that row's properties,
+  # of lists of scores parallel to keys2_by_property[prop].
+
+  def block_scores(self, keys1, props_list, keys2_by_property):
+    which_list = [[self.candidate_indexes(prop, keys2_by_property)
+                   for prop in props]
+                  for props in props_list]
+    if numpy != None:
+      rows1 = []
+      rows2 = []
+      for (key1, which) in zip(keys1, which_list):
+        i1 = self.index1[key1]
+        for w in which:
+          rows1.extend([i1] * len(w))
+          rows2.extend(w)
+      codes1 = self.codes1[rows1]
+      codes2 = self.codes2[rows2]
+      missing = (codes1 == 0) | (codes2 == 0)
+      d = numpy.where(missing, 1, numpy.where(codes1 == codes2, 100, 0))
+      scores = (d @ self.weight_vector).tolist()
+      result = []
+      start = 0
+      for which in which_list:
+        row_result = []
+        for w in which:
+          row_result.append(scores[start:start+len(w)])
+          start += len(w)
+        result.append(row_result)
+      return result
+    else:
+      weights = self.weights
+      all_codes2 = self.codes2
+      result = []
+      for (key1, which) in zip(keys1, which_list):
+        codes1 = self.codes1[self.index1[key1]]
+        row_result = []
+        for w in which:
+          scores = []
+          for i in w:
+            s = 0
+            for (weight, c1, c2) in zip(weights, codes1, all_codes2[i]):
+              if c1 == 0 or c2 == 0:
+                s += weight
+              elif c1 == c2:
+                s += 100 * weight
+            scores.append(s)
+          row_result.append(scores)
+        result.append(row_result)
+      return result
+
+  def candidate_indexes(self, prop, keys2_by_property):
+    index2 = self.index2
+    return [index2[key2] for key2 in keys2_by_property.get(prop, ())]
@@ -2,20 +2,29 @@
 
 import sys, argparse, csv
 from util import windex
+import extsort, keycodec
 
-def sort_csv(inport, key_columns, outport):
+# If memory (a number of bytes) is given, rows are sorted in runs of
+# about that size that are spilled to disk and merged.
+
+def sort_csv(inport, key_columns, outport, memory=None):
   reader = csv.reader(inport)
   header = next(reader)
   key_positions = [windex(header, pk_col) for pk_col in key_columns.split(",")]
   print("## Sort key positions: %s" % (key_positions,), file=sys.stderr)
 
+  # Same order as prepare.py and apply.py (see keycodec.py)
+  row_key = keycodec.key_function(key_positions)
   def sort_key(row):
-    return (tuple(row[pk_pos] for pk_pos in key_positions), row)
+    return (row_key(row), row)
 
-  rows = read_rows(reader)
+  if memory:
+    rows = extsort.sort_rows(reader, sort_key, budget=memory)
+  else:
+    rows = sorted(read_rows(reader), key=sort_key)
   writer = csv.writer(outport)
   writer.writerow(header)
-  for row in sorted(rows, key=sort_key):
+  for row in rows:
     assert len(row) == len(header)
     writer.writerow(row)
 
@@ -28,10 +37,15 @@ def read_rows(reader):
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="""
-    TBD
+    CSV rows are read from standard input, sorted by the given key
+    columns (numbers in numeric order, ahead of other values; ties
+    broken by the rest of the row), and written to standard output.
     """)
   parser.add_argument('--key',
                       help='comma-separated names of columns to sort by')
+  parser.add_argument('--memory', type=float, default=None,
+                      help='memory budget in megabytes; if given, sort in runs spilled to disk')
   # List of fields stored in database or graphdb should be an arg.
   args=parser.parse_args()
-  sort_csv(sys.stdin, args.key, sys.stdout)
+  memory = int(args.memory * 1024 * 1024) if args.memory else None
+  sort_csv(sys.stdin, args.key, sys.stdout, memory)
@@ -4,15 +4,61 @@
 #  - Normalizes tsv to csv
 #  - Makes sure all rows have the same number of fields
 
-import sys, csv, re, hashlib, argparse
+import sys, io, re, hashlib, argparse
+from collections import Counter, deque
 from util import csv_parameters, windex
+import csvio, metrics, pkcheck
 
 MISSING = ''
 
-def start_csv(inport, params, outport, pk_col, cleanp):
-  (d, q, g) = params
-  reader = csv.reader(inport, delimiter=d, quotechar=q, quoting=g)
+# Name to trace through clean_name, if any (--probe)
+probe = None
+
+def start_csv(inport, params, outport, pk_col, cleanp, processes=1,
+              pk_check="dict", expected_rows=None):
+  if expected_rows == None:
+    expected_rows = pkcheck.estimate_keys(inport)
+  if processes > 1:
+    start_csv_in_parallel(inport, params, outport, pk_col, cleanp, processes,
+                          pk_check, expected_rows)
+    return
+  reader = csvio.reader(inport, params)
   in_header = next(reader)
+  (out_header, rows) = start_rows(in_header, reader, pk_col, cleanp, pk_check,
+                                  expected_rows)
+  writer = csvio.writer(outport) # CSV not TSV
+  writer.writerow(out_header)
+  with metrics.phase("normalize"):
+    writer.writerows(rows)
+
+# Returns (out_header, out_rows) where out_rows is a generator of the
+# normalized rows.  Can be used as a stage in an in-process pipeline.
+# pk_check is the method for checking that primary keys are unique (see
+# pkcheck.py), and expected_rows, if known, helps it size itself.
+
+def start_rows(in_header, reader, pk_col, cleanp, pk_check="dict",
+               expected_rows=None):
+  (out_header, normalize) = normalizer(in_header, pk_col, cleanp)
+  pk_pos_out = windex(out_header, pk_col)
+
+  def generate():
+    counts = Counter()
+    checker = pkcheck.make_checker(pk_check, pk_col, expected_rows)
+    for row in reader:
+      out_row = normalize(row, counts)
+      checker.add(out_row[pk_pos_out])
+      yield out_row
+      counts["rows"] += 1
+    with metrics.phase("pk check"):
+      checker.finish()
+    report(counts, in_header)
+
+  return (out_header, generate())
+
+# Returns (out_header, normalize) where normalize(row, counts) returns
+# the normalized row, adding to counts (a Counter) as it goes.
+
+def normalizer(in_header, pk_col, cleanp):
   if len(in_header) == 1:
     if "," in in_header[0] or "\t" in in_header[0]:
       print("** start: Suspicious in_header", file=sys.stderr)
@@ -36,22 +82,14 @@ def start_csv(inport, params, outport, pk_col, cleanp):
     out_header = in_header
   pk_pos_out = windex(out_header, pk_col)
   print("Output header: %s" % (out_header,), file=sys.stderr)
+  clean = clean_name if probe == None else probing_clean_name(probe)
 
-  writer = csv.writer(outport) # CSV not TSV
-  writer.writerow(out_header)
-  count = 0
-  trimmed = 0
-  names_cleaned = 0
-  accepteds_cleaned = 0
-  minted = 0
-  seen_pks = {}
-  previous_pk = 0
-  for row in reader:
+  def normalize(row, counts):
 
     # Deal with raggedness if any
     if len(row) > len(in_header):
       row = row[0:len(in_header)]
-      trimmed += 1
+      counts["trimmed"] += 1
     elif len(row) < len(in_header):
       print(("** start: Unexpected number of columns: have %s want %s" %
              (len(row), len(in_header))),
@@ -61,10 +99,10 @@ def start_csv(inport, params, outport, pk_col, cleanp):
 
     # Clean up if wrong values in canonical and/or scientific name columns
     if cleanp:
-      if clean_name(row, can_pos, sci_pos):
-        names_cleaned += 1
+      if clean(row, can_pos, sci_pos):
+        counts["names_cleaned"] += 1
       if clean_accepted(row, accepted_pos, taxon_id_pos):
-        accepteds_cleaned += 1
+        counts["accepteds_cleaned"] += 1
 
     # landmark_status is specific to EOL
     if landmark_pos != None: 
@@ -91,27 +129,109 @@ def start_csv(inport, params, outport, pk_col, cleanp):
     if pk == MISSING:
       text = "^".join(row)
       pk = hashlib.sha1(text.encode('utf-8')).hexdigest()[0:8]
-      minted += 1
+      counts["minted"] += 1
       out_row[pk_pos_out] = pk
     assert pk != MISSING
-    if pk in seen_pks:
-      print("%s is not a good primary key column.  Two or more rows with %s = %s\n" %
-            (pk_col, pk_col, pk),
-            file=sys.stderr)
-      assert not (pk in seen_pks)
-    seen_pks[pk] = True
+    return out_row
 
-    writer.writerow(out_row)
-    count += 1
+  return (out_header, normalize)
+
+def report(counts, in_header):
+  for (name, n) in counts.items():
+    metrics.count(name, n)
   print("start: %s rows, %s columns, %s minted, %s names cleaned, %s accepted cleaned" %
-        (count, len(in_header), minted, names_cleaned, accepteds_cleaned),
+        (counts["rows"], len(in_header), counts["minted"],
+         counts["names_cleaned"], counts["accepteds_cleaned"]),
         file=sys.stderr)
-  if trimmed > 0:
+  if counts["trimmed"] > 0:
     # Ignoring extra values is appropriate behavior for DH 0.9.  But
     # elsewhere we might want ragged input to be treated as an error.
-    print("start: trimmed extra values from %s rows" % (trimmed,),
+    print("start: trimmed extra values from %s rows" % (counts["trimmed"],),
           file=sys.stderr)
-    
+
+# Multi-process version of start_csv.  The input is cut into chunks of
+# about CHUNK_LINES lines, always at the end of a record.  Worker processes
+# parse and normalize the chunks and return them as CSV text, together
+# with their primary keys.  The parent writes the chunks in input
+# order, checking the primary keys of each chunk along with those of all
+# earlier chunks, so the output is the same as with one process.
+
+CHUNK_LINES = 20000
+
+def start_csv_in_parallel(inport, params, outport, pk_col, cleanp, processes,
+                          pk_check="dict", expected_rows=None):
+  global _chunk_context
+  import multiprocessing
+  chunks = record_chunks(inport, params)
+  header_text = next(chunks, "")
+  in_header = next(csvio.reader(io.StringIO(header_text), params))
+  (out_header, normalize) = normalizer(in_header, pk_col, cleanp)
+  pk_pos_out = windex(out_header, pk_col)
+  writer = csvio.writer(outport)
+  writer.writerow(out_header)
+
+  _chunk_context = (params, normalize, pk_pos_out)
+  counts = Counter()
+  checker = pkcheck.make_checker(pk_check, pk_col, expected_rows)
+
+  def finish(result):
+    (text, pks, chunk_counts) = result.get()
+    for pk in pks:
+      checker.add(pk)
+    outport.write(text)
+    counts.update(chunk_counts)
+
+  try:
+    with metrics.phase("normalize"), \
+         multiprocessing.get_context("fork").Pool(processes) as pool:
+      # Keep a bounded number of chunks in flight, in input order
+      pending = deque()
+      for chunk in chunks:
+        pending.append(pool.apply_async(normalize_chunk, (chunk,)))
+        if len(pending) >= 2 * processes:
+          finish(pending.popleft())
+      while pending:
+        finish(pending.popleft())
+  finally:
+    _chunk_context = None
+  with metrics.phase("pk check"):
+    checker.finish()
+  report(counts, in_header)
+
+_chunk_context = None
+
+def normalize_chunk(text):
+  (params, normalize, pk_pos_out) = _chunk_context
+  counts = Counter()
+  out_rows = [normalize(row, counts)
+              for row in csvio.reader(io.StringIO(text), params)]
+  counts["rows"] += len(out_rows)
+  outport = io.StringIO()
+  csvio.writer(outport).writerows(out_rows)
+  return (outport.getvalue(), [row[pk_pos_out] for row in out_rows], counts)
+
+# Generator of pieces of the input text, each one a sequence of whole
+# records.  The first piece is just the header.  Where records end is
+# up to the csv module (a quote inside an unquoted field is just a
+# character, for instance), so the lines are run through a reader with
+# the same parameters as the workers', and a piece ends whenever the
+# reader has just finished a row.
+
+def record_chunks(inport, params):
+  lines = []
+  def taken():
+    for line in inport:
+      lines.append(line)
+      yield line
+  limit = 1
+  for row in csvio.reader(taken(), params):
+    if len(lines) >= limit:
+      yield "".join(lines)
+      lines.clear()
+      limit = CHUNK_LINES
+  if lines:
+    yield "".join(lines)
+
 """
 Let c = canonicalName from csv, s = scientificName from csv,
 sci = satisfies scientific name regex.
@@ -134,33 +254,30 @@ def clean_accepted(row, accepted_pos, taxon_id_pos):
     return True
   return False
 
-# Returns True if a change was made
-
-probe = "Callitrix torquatus Hoffmannsegg, 1807"
-probe = "Callitrix torquatus"
+# Returns True if a change was made.  trace, if not None, is called
+# with a description of each decision (see --probe).
 
-def clean_name(row, can_pos, sci_pos):
-  q = (probe in row[can_pos] or probe in row[sci_pos])
-  if q: print("##Looking", file=sys.stderr)
+def clean_name(row, can_pos, sci_pos, trace=None):
+  if trace: trace("Looking")
   if can_pos != None and sci_pos != None:
-    if q: print("##Positions yes", file=sys.stderr)
+    if trace: trace("Positions yes")
     c = row[can_pos]
     s = row[sci_pos]
     if s == MISSING:
-      if q: print("##Sci missing yes", file=sys.stderr)
+      if trace: trace("Sci missing yes")
       if is_scientific(c):
-        if q: print("##Can scientific yes", file=sys.stderr)
+        if trace: trace("Can scientific yes")
         row[sci_pos] = c
         row[can_pos] = MISSING
         return True
-      if q: print("##Can scientific no", file=sys.stderr)
+      if trace: trace("Can scientific no")
       return False
-    if q: print("##Sci missing no: %s | %s" % (c,s,), file=sys.stderr)
+    if trace: trace("Sci missing no: %s | %s" % (c,s,))
     if is_scientific(s):
-      if q: print("##Sci scientific, no clean", file=sys.stderr)
+      if trace: trace("Sci scientific, no clean")
       return False
     # s is nonnull and not 'scientific'
-    if q: print("##Sci not scientific", file=sys.stderr)
+    if trace: trace("Sci not scientific")
     if c == MISSING:
       # swap
       row[sci_pos] = None
@@ -168,19 +285,35 @@ def clean_name(row, can_pos, sci_pos):
       # print("start: c := s", file=sys.stderr) - frequent in DH 1.1
       return True
     if c == s:
-      if is_scientific(c):
-        # should gnparse!
-        row[can_pos] = None
-      else:
-        row[sci_pos] = None
+      # c is not 'scientific' either, since s isn't
+      row[sci_pos] = None
       # print("start: flush s", file=sys.stderr) - happens all the time in 1.1
       return True
   return False
 
+# Debugging aid: given a string, returns a version of clean_name that
+# traces its decisions for rows whose names contain that string.
+# Without a probe, clean_name is used as is and costs nothing extra.
+
+def probing_clean_name(probe):
+  def trace(message):
+    print("##%s" % message, file=sys.stderr)
+  def clean(row, can_pos, sci_pos):
+    q = ((can_pos != None and probe in row[can_pos]) or
+         (sci_pos != None and probe in row[sci_pos]))
+    return clean_name(row, can_pos, sci_pos, trace if q else None)
+  return clean
+
+# A name is 'scientific' if it contains a year (a word of four digits
+# starting with 1 or 2, after a space), as in "Callitrix torquatus
+# Hoffmannsegg, 1807".  Most names, including nearly all canonical
+# names, don't contain " 1" or " 2" at all, and two substring tests
+# settle those much faster than a regex search can.
+
 sci_re = re.compile(" [1-2][0-9]{3}\\b")
 
 def is_scientific(name):
-  return sci_re.search(name)
+  return (" 1" in name or " 2" in name) and sci_re.search(name) != None
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="""
@@ -195,15 +328,29 @@ if __name__ == '__main__':
                       help='clean up scientificName and canonicalName a little bit')
   parser.add_argument('--no-clean', dest='clean', action='store_false')
   parser.set_defaults(clean=True)
+  parser.add_argument('--probe', default=None,
+                      help='trace name cleaning for names containing this string')
+  parser.add_argument('--processes', type=int, default=1,
+                      help='number of processes to use for normalizing')
+  parser.add_argument('--pk-check', default="dict", choices=pkcheck.METHODS,
+                      help='how to check that primary keys are unique: dict is fastest, the others use less memory and report duplicates at the end')
+  parser.add_argument('--expected-rows', type=int, default=None,
+                      help='about how many rows the input has, for sizing --pk-check bloom (default: estimated from the size of the input file, if it is one)')
+  metrics.add_argument(parser)
 
   args=parser.parse_args()
+  probe = args.probe
   inpath = args.input
   params = csv_parameters(inpath)
-  if inpath == None:
-    start_csv(sys.stdin, params, sys.stdout, args.pk, args.clean)
-  else:
-    with open(args.input, "r") as inport:
-      start_csv(inport, params, sys.stdout, args.pk, args.clean)
+  with csvio.stdout() as outport:
+    if inpath == None:
+      start_csv(sys.stdin, params, outport, args.pk, args.clean,
+                args.processes, args.pk_check, args.expected_rows)
+    else:
+      with open(args.input, "r") as inport:
+        start_csv(inport, params, outport, args.pk, args.clean,
+                  args.processes, args.pk_check, args.expected_rows)
+  metrics.report("start", args.metrics_json)
 
 """
       # Assign ids (primary keys) to any nodes that don't have them
@@ -16,14 +16,26 @@ debug = False
 import sys, os, csv, argparse
 
 from util import MISSING, csv_parameters
+import checklist, csvio, metrics, traverse
 
-def main(infile, hier_path, root_id, outfile):
-  topo = read_topology(hier_path)
-  all = closure(topo, root_id)
-  write_subset(infile, root_id, all, topo, outfile)
+def main(infile, hier_path, root_ids, outfile, indexed=False):
+  with metrics.phase("topology"):
+    topo = read_topology(hier_path, indexed)
+  with metrics.phase("closure"):
+    all = traverse.NodeSet(topo)
+    for root_id in root_ids:
+      all.update(closure(topo, root_id))
+  with metrics.phase("write") as p:
+    p.rows = write_subset(infile, root_ids, all, topo, outfile)
+  metrics.count("rows", p.rows)
 
-def write_subset(infile, root_id, all, topo, outfile):
-  reader = csv.reader(infile)
+# Returns the number of rows looked at
+
+def write_subset(infile, root_ids, all, topo, outfile):
+  if isinstance(infile, checklist.Checklist):
+    write_subset_from_checklist(infile, all, outfile)
+    return len(all)
+  reader = csvio.reader(infile)
   head = next(reader)
 
   tid_column = head.index("taxonID") 
@@ -31,42 +43,192 @@ def write_subset(infile, root_id, all, topo, outfile):
   pid_column = head.index("parentNameUsageID")
   sid_column = head.index("taxonomicStatus")
 
-  writer = csv.writer(outfile)
+  # Membership in a mapped topology costs a binary search, so look the
+  # members up once
+  if isinstance(topo, traverse.MappedTopology):
+    all = set(all)
+
+  writer = csvio.writer(outfile)
+  writer.writerow(head)
+  count = 0
+  for batch in csvio.batches(reader):
+    writer.writerows(row for row in batch if row[tid_column] in all)
+    count += len(batch)
+  return count
+
+# Subset using the preorder/postorder labels written by
+# hierarchy.py --intervals, instead of computing a closure: one pass
+# over the checklist, testing each row's labels against the roots'.
+# Synonyms (which have no labels of their own) go with their accepted
+# usage.
+
+def write_subset_by_intervals(infile, labels, root_ids, outfile):
+  root_labels = []
+  for root_id in root_ids:
+    label = labels.get(root_id)
+    if label == None:
+      print("** No interval labels for root %s" % root_id, file=sys.stderr)
+    else:
+      root_labels.append(label)
+  subtrees = traverse.Subtrees(root_labels)
+  if isinstance(infile, checklist.Checklist):
+    (head, reader) = (infile.header, infile.values())
+  else:
+    reader = csvio.reader(infile)
+    head = next(reader)
+  tid_column = head.index("taxonID")
+  aid_column = head.index("acceptedNameUsageID")
+
+  writer = csvio.writer(outfile)
   writer.writerow(head)
-  for row in reader:
-    tid = row[tid_column]
-    if tid in all:
-      writer.writerow(row)
+  count = 0
+  with metrics.phase("write") as p:
+    for batch in csvio.batches(reader):
+      rows = []
+      for row in batch:
+        label = labels.get(row[tid_column]) or labels.get(row[aid_column])
+        if label != None and label in subtrees:
+          rows.append(row)
+      writer.writerows(rows)
+      count += len(rows)
+      p.rows += len(batch)
+  metrics.count("rows", p.rows)
+  print("  %s rows in %s subtree(s)" % (count, len(subtrees)), file=sys.stderr)
+
+# taxonID -> (preorder, postorder) from the output of hierarchy.py --intervals
+
+def read_intervals(path):
+  labels = {}
+  with open(path, "r") as infile:
+    print("Reading interval labels from %s" % path, flush=True, file=sys.stderr)
+    reader = csv.reader(infile)
+    head = next(reader)
+    tid_column = head.index("taxonID")
+    pre_column = head.index("preorder")
+    post_column = head.index("postorder")
+    for row in reader:
+      pre = row[pre_column]
+      if pre != MISSING:
+        labels[row[tid_column]] = (int(pre), int(row[post_column]))
+  return labels
+
+# Several subsets in one pass over the checklist.  routes is a list of
+# (root id, output path).  The hierarchy is read once (or with labels,
+# the interval labels are used instead), and each row is written to
+# every output whose subtree contains it.
+
+def write_subsets(infile, routes, hier_path=None, indexed=False, labels=None):
+  if isinstance(infile, checklist.Checklist):
+    (head, reader) = (infile.header, infile.values())
+  else:
+    reader = csvio.reader(infile)
+    head = next(reader)
+  tid_column = head.index("taxonID")
+  aid_column = head.index("acceptedNameUsageID")
+
+  if labels != None:
+    root_labels = []
+    for (root_id, _) in routes:
+      label = labels.get(root_id)
+      if label == None:
+        print("** No interval labels for root %s" % root_id, file=sys.stderr)
+      root_labels.append(label)
+    def targets(row):
+      label = labels.get(row[tid_column]) or labels.get(row[aid_column])
+      if label == None: return ()
+      (pre, post) = label
+      return [k for (k, root_label) in enumerate(root_labels)
+              if root_label != None and
+                 root_label[0] <= pre and post <= root_label[1]]
+  else:
+    with metrics.phase("topology"):
+      topo = read_topology(hier_path, indexed)
+    outputs_for = {}    # taxonID -> numbers of the outputs it goes to
+    with metrics.phase("closure"):
+      for (k, (root_id, _)) in enumerate(routes):
+        for tid in closure(topo, root_id):
+          ks = outputs_for.get(tid)
+          if ks == None:
+            outputs_for[tid] = [k]
+          else:
+            ks.append(k)
+    def targets(row):
+      return outputs_for.get(row[tid_column], ())
+
+  outfiles = [csvio.open_output(path) for (_, path) in routes]
+  writers = [csvio.writer(outfile) for outfile in outfiles]
+  for writer in writers:
+    writer.writerow(head)
+  counts = [0] * len(routes)
+  with metrics.phase("write") as p:
+    for row in reader:
+      for k in targets(row):
+        writers[k].writerow(row)
+        counts[k] += 1
+      p.rows += 1
+    for outfile in outfiles:
+      outfile.close()
+  metrics.count("rows", p.rows)
+  for ((root_id, path), count) in zip(routes, counts):
+    print("  %s rows under %s written to %s" % (count, root_id, path),
+          file=sys.stderr)
+
+# (root id, output path) pairs from a CSV file with columns root and output
+
+def read_routes(path):
+  with open(path, "r") as infile:
+    reader = csv.reader(infile)
+    head = next(reader)
+    root_column = head.index("root")
+    output_column = head.index("output")
+    return [(row[root_column], row[output_column]) for row in reader]
+
+# Look up the rows for the closure directly, instead of scanning the
+# whole checklist.  Rows are written in the checklist's order.
+
+def write_subset_from_checklist(ck, all, outfile):
+  assert ck.header[ck.pk_pos] == "taxonID"
+  found = [ck.find(tid) for tid in all]
+  writer = csvio.writer(outfile)
+  writer.writerow(ck.header)
+  writer.writerows(ck.row(i) for i in sorted(i for i in found if i != None))
 
 # Transitive closure of accepted records
 
 def closure(topo, root_id):
   print("Computing transitive closure starting from %s" % root_id,
         flush=True, file=sys.stderr)
-  all = {}
-  empty = []
-  def descend(id):
-    if not id in all:
-      all[id] = True
-      if id in topo:
-        (children, synonyms) = topo[id]
-        for child in children:
-          descend(child)
-        for syn in synonyms:
-          descend(syn)
-  descend(root_id)
+  i = topo.find(root_id)
+  all = topo.closure(i) if i != None else traverse.NodeSet(topo)
   assert len(all) > 1
   print("  %s nodes in transitive closure" % len(all), file=sys.stderr)
   return all
 
-def read_topology(hier_path):
-  # Keyed by taxon id
-  topo = {}
-  (delimiter, quotechar, mode) = csv_parameters(hier_path)
+# With indexed, the topology is kept in a file next to the hierarchy
+# file (see traverse.save_topology), used as long as the hierarchy
+# file's contents haven't changed.
+
+TOPOLOGY_SUFFIX = ".topology"
+
+def read_topology(hier_path, indexed=False):
+  if indexed:
+    path = hier_path + TOPOLOGY_SUFFIX
+    topo = traverse.load_topology(path, hier_path)
+    if topo != None:
+      print("Using topology index %s (%s nodes)" % (path, len(topo)),
+            file=sys.stderr)
+      return topo
+    topo = scan_topology(hier_path)
+    traverse.save_topology(topo, path, hier_path)
+    return topo
+  return scan_topology(hier_path)
+
+def scan_topology(hier_path):
+  topo = traverse.Topology()
   counter = 0
   with open(hier_path, "r") as infile:
     print("Scanning %s to obtain hierarchy" % hier_path, flush=True, file=sys.stderr)
-    reader = csv.reader(infile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
+    reader = csvio.reader(infile, csv_parameters(hier_path))
     head = next(reader)
 
     tid_column = head.index("taxonID") 
@@ -93,23 +255,16 @@ def read_topology(hier_path):
       # is a conflict.
       # (accepted_id and not accepted_id == tid))
       if accepted_id != MISSING and accepted_id != tid:
-        (_, syns) = get_topo_record(accepted_id, topo)
-        syns.append(tid)
+        topo.add_synonym(accepted_id, tid)
       if parent_id != MISSING and parent_id != tid:
-        (children, _) = get_topo_record(parent_id, topo)
-        children.append(tid)
+        topo.add_child(parent_id, tid)
+    linked = sum(1 for i in range(len(topo))
+                 if topo.children[i] or topo.synonyms[i])
     print("  %s nodes of which %s have children and/or synonyms" %
-          (counter, len(topo)), file=sys.stderr)
+          (counter, linked), file=sys.stderr)
 
   return topo
 
-def get_topo_record(tid, topo):
-  record = topo.get(tid)
-  if not record:
-    record = ([], [])
-    topo[tid] = record
-  return record
-
 # main(checklist, taxonomy, root_id, outfile)
 
 if __name__ == '__main__':
@@ -117,6 +272,30 @@ if __name__ == '__main__':
   parser.add_argument('--hierarchy',
                       help="file from which to extract complete hierarchy")
   parser.add_argument('--root',
-                      help="taxonID of root of subtree to be extracted")
+                      help="taxonID of root of subtree to be extracted, or a,b,c for several")
+  parser.add_argument('--input', default=None,
+                      help="binary checklist file to take the subset of, instead of standard input")
+  parser.add_argument('--index', action='store_true',
+                      help="keep the hierarchy's topology in an index file next to it, built if needed")
+  parser.add_argument('--intervals',
+                      help="output of hierarchy.py --intervals, to use instead of --hierarchy")
+  parser.add_argument('--roots',
+                      help="CSV file with columns root and output, to write several subsets in one pass")
+  metrics.add_argument(parser)
   args = parser.parse_args()
-  main(sys.stdin, args.hierarchy, args.root, sys.stdout)
+  infile = checklist.Checklist(args.input) if args.input else sys.stdin
+  labels = None
+  if args.intervals:
+    with metrics.phase("labels"):
+      labels = read_intervals(args.intervals)
+  if args.roots:
+    write_subsets(infile, read_routes(args.roots),
+                  args.hierarchy, args.index, labels)
+  else:
+    root_ids = args.root.split(",")
+    with csvio.stdout() as outport:
+      if args.intervals:
+        write_subset_by_intervals(infile, labels, root_ids, outport)
+      else:
+        main(infile, args.hierarchy, root_ids, outport, args.index)
+  metrics.report("subset", args.metrics_json)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# Writes a synthetic Darwin Core taxon table, for benchmarks.
+#
+#   python3 synth.py --rows 1000000 --depth 7 --fanout 6 > v1.csv
+#   python3 synth.py --rows 1000000 --depth 7 --fanout 6 --churn 0.05 > v2.csv
+#
+# Accepted usages form a tree, written breadth first, so that parents
+# come before their children.  Level 0 is the root, level i has fanout
+# times as many usages as level i-1, and the deepest level (depth - 1)
+# takes all the usages that are left, under parents chosen at random.
+# Each accepted usage may be followed by synonyms, half of which have
+# its canonical name.  With collisions, an accepted usage may have the
+# same canonical name as some earlier one.
+#
+# Every choice is a hash of the seed and the usage's number, so the
+# rows can be generated one at a time in constant memory, and two runs
+# with the same seed but different churn are two versions of the same
+# checklist: the later version has renamed usages, changed datasets,
+# new taxonIDs for old usages (carried to their children and
+# synonyms), removed synonyms and added species.
+
+import sys, argparse
+from bisect import bisect_right
+from math import gcd
+import csvio
+from util import csv_parameters
+
+HEADER = ["taxonID", "parentNameUsageID", "acceptedNameUsageID",
+          "scientificName", "canonicalName", "taxonRank",
+          "taxonomicStatus", "datasetID"]
+
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus",
+         "species", "subspecies", "variety", "form"]
+GENUS_LEVEL = RANKS.index("genus")
+
+SYLLABLES = ["a", "ba", "ca", "da", "e", "fe", "go", "hi", "i", "la", "me",
+             "no", "o", "pe", "ra", "si", "tu", "u", "va", "xi", "ze", "ly"]
+AUTHORS = ["L.", "Smith", "Jones", "Müller", "Dupont", "Rossi", "Tanaka",
+           "Ivanov", "Silva", "Nakamura"]
+DATASETS = 5
+
+MASK = (1 << 64) - 1
+MULTIPLIER = 2654435761
+
+# splitmix64 of (seed, salt, n)
+def mix(seed, salt, n):
+  z = (seed * 0x9E3779B97F4A7C15 + salt * 0xD1B54A32D192ED03 + n) & MASK
+  z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+  z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK
+  return z ^ (z >> 31)
+
+# Each usage gets one hash, mix(seed, USAGE, n), and each thing decided
+# about it takes 16 bits of the hash: a fraction in [0, 1) from
+# fraction(h, field), or a small number from field(h, field).  Rows
+# and the parents of the deepest level get their own hashes.
+
+(USAGE, ROW, PARENT, COLLISION) = range(4)
+(COLLIDES, CHURNS, CHANGE, NAME) = range(4)
+
+def field(h, k):
+  return (h >> (16 * k)) & 0xFFFF
+
+def fraction(h, k):
+  return field(h, k) / 65536.0
+
+# Sizes of the levels of a tree of about accepted usages
+def level_sizes(accepted, depth, fanout):
+  sizes = []
+  (size, total) = (1, 0)
+  while total < accepted and len(sizes) < depth:
+    if len(sizes) == depth - 1:
+      size = accepted - total
+    size = min(size, accepted - total)
+    sizes.append(size)
+    total += size
+    size *= fanout
+  return sizes
+
+PAIRS = [a + b for a in SYLLABLES for b in SYLLABLES]
+
+def word(n):
+  (n, k) = divmod(n, len(SYLLABLES))
+  parts = [SYLLABLES[k]]
+  while n:
+    (n, k) = divmod(n, len(PAIRS))
+    parts.append(PAIRS[k])
+  return "".join(parts)
+
+CHANGES = ("rename", "reid", "dataset", "remove", "add")
+
+class Synth:
+  def __init__(self, rows, depth=7, fanout=6, synonyms=0.2, collisions=0.01,
+               churn=0.0, seed=1):
+    (self.rows, self.fanout, self.synonyms, self.collisions,
+     self.churn, self.seed) = (rows, fanout, synonyms, collisions, churn, seed)
+    self.sizes = level_sizes(max(1, round(rows * (1 - synonyms))),
+                             depth, fanout)
+    self.starts = [sum(self.sizes[0:i]) for i in range(len(self.sizes))]
+    self.last = len(self.sizes) - 1
+    # taxonIDs are a permutation of 0 .. 20 * rows, so they look
+    # random.  Usage n (see change) gets n, or 2 * rows + n if churn
+    # changes it, and additions get 4 * rows + n.
+    self.space = 20 * max(rows, 1)
+    while gcd(MULTIPLIER, self.space) != 1:
+      self.space += 1
+
+  def hash(self, n):
+    return mix(self.seed, USAGE, n)
+
+  def id(self, n):
+    return str(n * MULTIPLIER % self.space + 1)
+
+  def level(self, k):
+    if k >= self.starts[self.last]: return self.last
+    return bisect_right(self.starts, k) - 1
+
+  def parent(self, k):
+    i = self.level(k)
+    if i == 0: return None
+    j = k - self.starts[i]
+    if i < self.last:
+      return self.starts[i-1] + j // self.fanout
+    return self.starts[i-1] + mix(self.seed, PARENT, k) % self.sizes[i-1]
+
+  # What churn does to usage number n (accepted k is n = k, synonym
+  # in row r is n = rows + r), whose hash is h: None, or one of
+  # CHANGES.  Only synonyms are removed.
+  def change(self, h):
+    if self.churn <= 0 or fraction(h, CHURNS) >= self.churn:
+      return None
+    return CHANGES[field(h, CHANGE) % len(CHANGES)]
+
+  def usage_id(self, n, h=None):
+    if self.churn > 0 and self.change(self.hash(n) if h == None else h) == "reid":
+      return self.id(2 * self.rows + n)
+    return self.id(n)
+
+  def canonical(self, k, h):
+    if k > 0 and fraction(h, COLLIDES) < self.collisions:
+      k = mix(self.seed, COLLISION, k) % k
+    i = self.level(k)
+    if i < GENUS_LEVEL:
+      return word(k).capitalize()
+    if i == GENUS_LEVEL:
+      return "%sus" % word(k).capitalize()
+    genus = k
+    while self.level(genus) > GENUS_LEVEL:
+      genus = self.parent(genus)
+    name = "%sus %si" % (word(genus).capitalize(), word(k))
+    if i > GENUS_LEVEL + 1:
+      name = "%s %s" % (name, word(k + i))
+    return name
+
+  def rank(self, k):
+    return RANKS[min(self.level(k), len(RANKS) - 1)]
+
+  def scientific(self, canonical, h):
+    f = field(h, NAME)
+    what = f % 20
+    author = AUTHORS[(f // 20) % len(AUTHORS)]
+    if what < 12:
+      return "%s %s, %s" % (canonical, author, 1758 + (f // 200) % 265)
+    if what < 16:
+      return "%s %s" % (canonical, author)
+    if what < 19:
+      return canonical
+    return ""
+
+  def accepted_row(self, k, h):
+    p = self.parent(k)
+    canonical = self.canonical(k, h)
+    row = [self.usage_id(k, h), self.usage_id(p) if p != None else "", "",
+           self.scientific(canonical, h), canonical, self.rank(k),
+           "accepted", "ds%s" % (k % DATASETS)]
+    return self.changed(row, h)
+
+  def synonym_row(self, n, k, h):
+    if fraction(h, COLLIDES) < 0.5:
+      canonical = self.canonical(k, self.hash(k))    # same name, other authority
+    else:
+      canonical = "%sus %sa" % (word(n).capitalize(), word(k))
+    row = [self.usage_id(n, h), "", self.usage_id(k),
+           self.scientific(canonical, h), canonical, self.rank(k),
+           "synonym", "ds%s" % (n % DATASETS)]
+    return self.changed(row, h)
+
+  def changed(self, row, h):
+    what = self.change(h)
+    if what == "rename":
+      row[4] = row[4] + "a"
+      row[3] = row[4] if row[3] else ""
+    elif what == "dataset":
+      row[7] = "ds%s" % DATASETS
+    elif what == "remove" and row[6] == "synonym":
+      return None
+    return row
+
+  # An accepted species added under the accepted usage k
+  def added_row(self, n, k):
+    canonical = "%sus %sae" % (word(k).capitalize(), word(n))
+    return [self.id(4 * self.rows + n), self.usage_id(k), "",
+            canonical, canonical, "species", "accepted",
+            "ds%s" % (n % DATASETS)]
+
+  # Generator of rows (not including the header)
+  def generate(self):
+    k = 0          # number of the next accepted usage
+    for r in range(self.rows):
+      if k > 0 and mix(self.seed, ROW, r) / 18446744073709551616.0 < self.synonyms:
+        n = self.rows + r
+        h = self.hash(n)
+        row = self.synonym_row(n, k - 1, h)
+      else:
+        n = k
+        h = self.hash(n)
+        row = self.accepted_row(k, h)
+        k += 1
+      if row != None:
+        yield row
+      if self.churn > 0 and self.change(h) == "add":
+        yield self.added_row(n, k - 1)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="""
+    Write a synthetic Darwin Core taxon table to standard output.
+    """)
+  parser.add_argument('--rows', type=int, default=10000,
+                      help='number of usages (before churn)')
+  parser.add_argument('--depth', type=int, default=7,
+                      help='number of levels in the tree of accepted usages')
+  parser.add_argument('--fanout', type=int, default=6,
+                      help='children per accepted usage, except at the deepest level')
+  parser.add_argument('--synonyms', type=float, default=0.2,
+                      help='fraction of usages that are synonyms')
+  parser.add_argument('--collisions', type=float, default=0.01,
+                      help='fraction of accepted usages whose canonical name is also some other usage\'s')
+  parser.add_argument('--churn', type=float, default=0.0,
+                      help='fraction of usages changed, to make a later version of the same checklist')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--tsv', action='store_true',
+                      help='write TSV, as Darwin Core archives usually are, instead of CSV')
+  parser.add_argument('--mapping',
+                      help='also write a taxonID to EOLid mapping for every usage to this file')
+  args=parser.parse_args()
+  synth = Synth(args.rows, args.depth, args.fanout, args.synonyms,
+                args.collisions, args.churn, args.seed)
+  print("synth: levels %s" % (synth.sizes,), file=sys.stderr)
+  params = csv_parameters("x.tsv" if args.tsv else "x.csv")
+  with csvio.stdout() as outport:
+    writer = csvio.writer(outport, params)
+    writer.writerow(HEADER)
+    if args.mapping:
+      with open(args.mapping, "w", newline="") as mapport:
+        mapping = csvio.writer(mapport)
+        mapping.writerow(["taxonID", "EOLid"])
+        for row in synth.generate():
+          writer.writerow(row)
+          mapping.writerow([row[0], str(int(row[0]) + 500000000)])
+    else:
+      writer.writerows(synth.generate())
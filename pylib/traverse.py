@@ -0,0 +1,399 @@
+# Traversals over a taxonomic hierarchy, shared by subset.py and
+# hierarchy.py.
+
+# Nodes are numbered 0, 1, 2, ... in order of first appearance, and
+# the results of traversals are bitmaps over node numbers (NodeSet).
+# Traversal uses an explicit stack, so depth is not limited by Python's
+# recursion limit.  A Topology remembers the closure computed for each
+# root, and a later traversal that runs into an earlier root picks up
+# its closure instead of descending again, so many root queries
+# against one topology don't repeat work.  reach, for many nodes at
+# once, is a single walk instead.
+
+import sys, os, mmap, struct, hashlib, bisect
+from array import array
+
+class Topology:
+  def __init__(self):
+    self.ids = []          # node number -> taxon id
+    self.numbers = {}      # taxon id -> node number
+    self.children = []     # node number -> list of node numbers, or None
+    self.synonyms = []     # node number -> list of node numbers, or None
+    self.memo = {}         # (node number, with synonyms) -> NodeSet
+
+  def __len__(self):
+    return len(self.ids)
+
+  # Node number for tid, or None if tid has not been seen
+  def find(self, tid):
+    return self.numbers.get(tid)
+
+  # Node number for tid, adding a node if necessary
+  def node(self, tid):
+    i = self.numbers.get(tid)
+    if i == None:
+      i = len(self.ids)
+      self.numbers[tid] = i
+      self.ids.append(tid)
+      self.children.append(None)
+      self.synonyms.append(None)
+    return i
+
+  def add_child(self, parent_tid, child_tid):
+    add_link(self.children, self.node(parent_tid), self.node(child_tid))
+    self.memo = {}
+
+  def add_synonym(self, accepted_tid, synonym_tid):
+    add_link(self.synonyms, self.node(accepted_tid), self.node(synonym_tid))
+    self.memo = {}
+
+  def child_numbers(self, i):
+    return self.children[i] or ()
+
+  def synonym_numbers(self, i):
+    return self.synonyms[i] or ()
+
+  # Set of nodes reachable from node number i by child (and, if
+  # synonyms is true, synonym) links, including i itself.
+
+  def closure(self, i, synonyms=True):
+    memo_key = (i, synonyms)
+    found = self.memo.get(memo_key)
+    if found != None: return found
+    result = NodeSet(self)
+    bits = result.bits
+    stack = [i]
+    while stack:
+      j = stack.pop()
+      if bits[j >> 3] & (1 << (j & 7)): continue
+      earlier = self.memo.get((j, synonyms)) if j != i else None
+      if earlier != None:
+        result.update(earlier)
+        continue
+      bits[j >> 3] |= 1 << (j & 7)
+      stack.extend(self.child_numbers(j))
+      if synonyms:
+        stack.extend(self.synonym_numbers(j))
+    self.memo[memo_key] = result
+    return result
+
+  # Union of the closures of several nodes, in one walk from all of
+  # them together, so the cost goes with the size of the topology and
+  # not with the number of nodes given.  Unlike closure, nothing is
+  # remembered.
+  def reach(self, numbers, synonyms=True):
+    result = NodeSet(self)
+    bits = result.bits
+    stack = list(numbers)
+    while stack:
+      j = stack.pop()
+      if bits[j >> 3] & (1 << (j & 7)): continue
+      bits[j >> 3] |= 1 << (j & 7)
+      stack.extend(self.child_numbers(j))
+      if synonyms:
+        stack.extend(self.synonym_numbers(j))
+    return result
+
+  # Preorder and postorder numbers for the nodes reachable from the
+  # given node numbers by child links, as two integer arrays indexed by
+  # node number (-1 for nodes not reached).  Node x is in the subtree
+  # rooted at r exactly when
+  #   preorder[r] <= preorder[x] and postorder[x] <= postorder[r].
+
+  def intervals(self, roots):
+    n = len(self)
+    preorder = array('q', [-1]) * n
+    postorder = array('q', [-1]) * n
+    (pre, post) = (0, 0)
+    # ~i on the stack means all of i's descendants have been numbered
+    stack = list(reversed(roots))
+    while stack:
+      i = stack.pop()
+      if i < 0:
+        postorder[~i] = post
+        post += 1
+      elif preorder[i] < 0:
+        preorder[i] = pre
+        pre += 1
+        stack.append(~i)
+        stack.extend(reversed(self.child_numbers(i)))
+    return (preorder, postorder)
+
+# A topology over nodes 0 .. n-1 given by an array of parent numbers
+# (-1 for none), with no ids and no synonyms, for hierarchy.py
+# --streaming.  Children are kept the way MappedTopology keeps them,
+# as offsets into one array of targets, in node number order, so the
+# whole topology is a few integers per node.
+
+class ParentTopology(Topology):
+  def __init__(self, parents):
+    n = len(parents)
+    offsets = array('q', [0]) * (n + 1)
+    for p in parents:
+      if p >= 0: offsets[p + 1] += 1
+    for i in range(n):
+      offsets[i + 1] += offsets[i]
+    fill = offsets[0:n]
+    targets = array('i', [0]) * offsets[n]
+    for (i, p) in enumerate(parents):
+      if p >= 0:
+        targets[fill[p]] = i
+        fill[p] += 1
+    self.size = n
+    self.child_offsets = offsets
+    self.child_targets = targets
+    self.memo = {}
+
+  def __len__(self):
+    return self.size
+
+  def child_numbers(self, i):
+    offsets = self.child_offsets
+    return self.child_targets[offsets[i]:offsets[i+1]]
+
+  def synonym_numbers(self, i):
+    return ()
+
+  def with_children(self):
+    offsets = self.child_offsets
+    return sum(1 for i in range(self.size) if offsets[i+1] > offsets[i])
+
+def add_link(links, i, j):
+  have = links[i]
+  if have == None:
+    links[i] = [j]
+  else:
+    have.append(j)
+
+# A union of subtrees, given the (preorder, postorder) labels of their
+# roots.  Membership of a node, given its labels, is a binary search
+# and two comparisons.
+
+class Subtrees:
+  def __init__(self, labels):
+    # Drop subtrees that are inside other ones; the rest are disjoint
+    self.intervals = []
+    for (pre, post) in sorted(labels):
+      if self.intervals and post <= self.intervals[-1][1]: continue
+      self.intervals.append((pre, post))
+    self.starts = [pre for (pre, _) in self.intervals]
+
+  def __len__(self):
+    return len(self.intervals)
+
+  def __contains__(self, label):
+    (pre, post) = label
+    k = bisect.bisect_right(self.starts, pre) - 1
+    return k >= 0 and post <= self.intervals[k][1]
+
+# A set of nodes of a topology, as a bitmap over node numbers.
+# Membership can be tested by node number or by taxon id.
+
+class NodeSet:
+  def __init__(self, topology):
+    self.topology = topology
+    self.bits = bytearray((len(topology) + 7) // 8)
+
+  def has_number(self, i):
+    return i < len(self.bits) * 8 and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+  def __contains__(self, tid):
+    i = self.topology.find(tid)
+    return i != None and self.has_number(i)
+
+  def update(self, other):
+    n = len(self.bits)
+    union = int.from_bytes(self.bits, 'little') | \
+            int.from_bytes(other.bits, 'little')
+    self.bits[:] = union.to_bytes(n, 'little')
+
+  def __len__(self):
+    return int.from_bytes(self.bits, 'little').bit_count()
+
+  def numbers(self):
+    bits = self.bits
+    for k in range(len(bits)):
+      b = bits[k]
+      if b:
+        for m in range(8):
+          if b & (1 << m):
+            yield (k << 3) | m
+
+  # Taxon ids of the members
+  def __iter__(self):
+    ids = self.topology.ids
+    return (ids[i] for i in self.numbers())
+
+# A topology can be saved in a compact file and later used through mmap
+# (MappedTopology) without re-reading the hierarchy.  Layout (integers
+# are little-endian):
+#   magic "PLTOPO01"
+#   uint64 number of nodes, uint64 child links, uint64 synonym links
+#   source: 20-byte SHA-1 of the file the topology was read from,
+#     uint64 its size, uint64 its modification time (ns)
+#   child offsets: (nodes + 1) uint64; child targets: uint32 node numbers
+#   synonym offsets and targets, the same way
+#   id offsets: (nodes + 1) uint64; ids: UTF-8, concatenated
+# Nodes are renumbered in taxon id order (UTF-8 bytes, the same as
+# Python's string order), so that a taxon id is found by binary search.
+
+TOPOLOGY_MAGIC = b"PLTOPO01"
+HEADER = struct.Struct("<QQQ20sQQ")
+
+def source_hash(path):
+  h = hashlib.sha1()
+  with open(path, "rb") as infile:
+    while True:
+      chunk = infile.read(1 << 20)
+      if not chunk: break
+      h.update(chunk)
+  return h.digest()
+
+def source_stamp(path):
+  st = os.stat(path)
+  return (st.st_size, st.st_mtime_ns)
+
+def save_topology(topo, path, source_path):
+  n = len(topo)
+  if n >= 2**32:
+    print("** traverse: Too many nodes (%s)" % n, file=sys.stderr)
+    assert False
+  ids = topo.ids
+  order = sorted(range(n), key=lambda i: ids[i])
+  renumber = array('I', bytes(4 * n))
+  for (new, old) in enumerate(order):
+    renumber[old] = new
+
+  def csr(links):
+    offsets = array('Q', [0])
+    targets = array('I')
+    for old in order:
+      targets.extend(renumber[j] for j in links[old] or ())
+      offsets.append(len(targets))
+    return (offsets, targets)
+
+  (child_offsets, child_targets) = csr(topo.children)
+  (synonym_offsets, synonym_targets) = csr(topo.synonyms)
+  id_offsets = array('Q', [0])
+  id_data = []
+  position = 0
+  for old in order:
+    tid = ids[old].encode('utf-8')
+    id_data.append(tid)
+    position += len(tid)
+    id_offsets.append(position)
+
+  (size, mtime) = source_stamp(source_path)
+  with open(path + ".new", "wb") as outfile:
+    outfile.write(TOPOLOGY_MAGIC)
+    outfile.write(HEADER.pack(n, len(child_targets), len(synonym_targets),
+                              source_hash(source_path), size, mtime))
+    for a in (child_offsets, child_targets, synonym_offsets, synonym_targets,
+              id_offsets):
+      a.tofile(outfile)
+    outfile.write(b"".join(id_data))
+  os.replace(path + ".new", path)
+  print("Wrote topology index %s (%s nodes)" % (path, n), file=sys.stderr)
+
+# The saved topology at path, if it was made from the current contents
+# of source_path, otherwise None.  The source file is hashed only if its
+# size or modification time has changed since the index was written.
+
+def load_topology(path, source_path):
+  if not os.path.exists(path): return None
+  with open(path, "rb") as infile:
+    head = infile.read(len(TOPOLOGY_MAGIC) + HEADER.size)
+  if len(head) < len(TOPOLOGY_MAGIC) + HEADER.size or \
+     not head.startswith(TOPOLOGY_MAGIC):
+    return None
+  (_, _, _, digest, size, mtime) = \
+    HEADER.unpack_from(head, len(TOPOLOGY_MAGIC))
+  stamp = source_stamp(source_path)
+  if (size, mtime) != stamp:
+    if source_hash(source_path) != digest: return None
+    # Same contents, e.g. copied or touched; remember the new stamp
+    with open(path, "r+b") as outfile:
+      outfile.seek(len(TOPOLOGY_MAGIC) + HEADER.size - 16)
+      outfile.write(struct.pack("<QQ", *stamp))
+  return MappedTopology(path)
+
+class MappedTopology(Topology):
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "rb")
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    m = self.map
+    assert m[0:len(TOPOLOGY_MAGIC)] == TOPOLOGY_MAGIC
+    (n, nchildren, nsynonyms, _, _, _) = \
+      HEADER.unpack_from(m, len(TOPOLOGY_MAGIC))
+    view = memoryview(m)
+    p = len(TOPOLOGY_MAGIC) + HEADER.size
+
+    def take(count, code, width):
+      nonlocal p
+      a = view[p:p+width*count].cast(code)
+      p += width * count
+      return a
+
+    self.child_offsets = take(n + 1, 'Q', 8)
+    self.child_targets = take(nchildren, 'I', 4)
+    self.synonym_offsets = take(n + 1, 'Q', 8)
+    self.synonym_targets = take(nsynonyms, 'I', 4)
+    self.ids = IdTable(m, take(n + 1, 'Q', 8), p)
+    self.memo = {}
+
+  def close(self):
+    self.child_offsets = self.child_targets = None
+    self.synonym_offsets = self.synonym_targets = None
+    self.ids = self.memo = None
+    self.map.close()
+    self.file.close()
+
+  def __len__(self):
+    return len(self.ids)
+
+  def find(self, tid):
+    return self.ids.find(tid)
+
+  def node(self, tid):
+    return self.find(tid)
+
+  def child_numbers(self, i):
+    offsets = self.child_offsets
+    return self.child_targets[offsets[i]:offsets[i+1]]
+
+  def synonym_numbers(self, i):
+    offsets = self.synonym_offsets
+    return self.synonym_targets[offsets[i]:offsets[i+1]]
+
+# Taxon ids of a MappedTopology, by node number
+class IdTable:
+  def __init__(self, m, offsets, start):
+    self.map = m
+    self.offsets = offsets
+    self.start = start
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def id_bytes(self, i):
+    start = self.start
+    return self.map[start+self.offsets[i]:start+self.offsets[i+1]]
+
+  def __getitem__(self, i):
+    return self.id_bytes(i).decode('utf-8')
+
+  # Node number for tid, or None (binary search)
+  def find(self, tid):
+    target = tid.encode('utf-8')
+    (lo, hi) = (0, len(self))
+    while lo < hi:
+      mid = (lo + hi) // 2
+      probe = self.id_bytes(mid)
+      if probe < target:
+        lo = mid + 1
+      elif probe > target:
+        hi = mid
+      else:
+        return mid
+    return None
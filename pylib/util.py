@@ -2,10 +2,15 @@
 # Things used in more than one plotter python file
 
 import sys, io, argparse, csv
+from array import array
+from operator import itemgetter
 
 MISSING = ''
 
-def read_csv(inport, pk_col=None, key=None):
+# If columnar is true, the rows are returned in a ColumnarRows instead
+# of a dict.
+
+def read_csv(inport, pk_col=None, key=None, columnar=False):
   reader = csv.reader(inport)
   header = next(reader)
   assert pk_col == None or key == None
@@ -19,10 +24,11 @@ def read_csv(inport, pk_col=None, key=None):
     keyfun = lambda row: row[pk_pos]
   else:
     keyfun = key
-  return (header, read_rows(reader, key=keyfun))
+  store = ColumnarRows(len(header)) if columnar else None
+  return (header, read_rows(reader, key=keyfun, store=store))
 
-def read_rows(reader, key=lambda row: row):
-  all_rows = {}
+def read_rows(reader, key=lambda row: row, store=None):
+  all_rows = {} if store == None else store
   for row in reader:
     ky = key(row)
     if ky in all_rows:
@@ -30,39 +36,179 @@ def read_rows(reader, key=lambda row: row):
             file=sys.stderr)
       assert False
     all_rows[ky] = row
+  if store != None:
+    store.freeze()
   print("Read %s rows" % len(all_rows), file=sys.stderr)
   return all_rows
 
+# A read-only mapping from primary key to row, like the dict made by
+# read_rows, but with the rows stored column by column.  A column with
+# few distinct values (rank, status, dataset id) is kept as an array of
+# integer codes into a list of those values, so each value is stored
+# once.  Columns that turn out to be mostly distinct (ids, names) are
+# kept as plain lists of values.  There is no list object per row;
+# rows are materialized as fresh lists when they are asked for.
+
+# Number of rows to look at before deciding how to store each column
+SAMPLE_ROWS = 1000
+
+class ColumnarRows:
+  def __init__(self, width):
+    self.width = width
+    self.index = {}                 # key -> row number
+    self.columns = [[] for j in range(width)]  # values, or the distinct values
+    self.codes = [array('I') for j in range(width)]   # None if plain
+    self.tables = [{} for j in range(width)]    # value -> code
+
+  def __setitem__(self, key, row):
+    if key in self.index:
+      print("ColumnarRows: duplicate key %s" % (key,), file=sys.stderr)
+      assert False
+    if len(row) != self.width:
+      print("ColumnarRows: row has %s fields, want %s: %s" %
+            (len(row), self.width, row),
+            file=sys.stderr)
+      assert False
+    if self.tables == None:
+      self.tables = [{value: code for (code, value) in enumerate(values)}
+                     if codes != None else None
+                     for (values, codes) in zip(self.columns, self.codes)]
+    self.index[key] = len(self.index)
+    for (value, values, codes, table) in \
+          zip(row, self.columns, self.codes, self.tables):
+      if codes == None:
+        values.append(value)
+      else:
+        code = table.get(value)
+        if code == None:
+          code = len(values)
+          values.append(value)
+          table[value] = code
+        codes.append(code)
+    if len(self.index) == SAMPLE_ROWS:
+      for j in range(self.width):
+        if len(self.columns[j]) > SAMPLE_ROWS // 2:
+          self.columns[j] = [self.columns[j][code] for code in self.codes[j]]
+          self.codes[j] = None
+          self.tables[j] = None
+
+  # Drop the interning tables once loading is done; they are rebuilt
+  # if more rows are added.
+  def freeze(self):
+    self.tables = None
+
+  def row(self, i):
+    return [values[i] if codes == None else values[codes[i]]
+            for (values, codes) in zip(self.columns, self.codes)]
+
+  def __getitem__(self, key):
+    return self.row(self.index[key])
+
+  def get(self, key, default=None):
+    i = self.index.get(key)
+    if i == None: return default
+    return self.row(i)
+
+  def __contains__(self, key):
+    return key in self.index
+
+  def __len__(self):
+    return len(self.index)
+
+  def __iter__(self):
+    return iter(self.index)
+
+  def keys(self):
+    return self.index.keys()
+
+  def values(self):
+    return (self.row(i) for i in self.index.values())
+
+  def items(self):
+    return ((key, self.row(i)) for (key, i) in self.index.items())
+
 def windex(header, fieldname):
   if fieldname in header:
     return header.index(fieldname)
   else:
     return None
 
-# Returns row with same length as correspondence
+# correspondence(headera, headerb) maps rows with headera's columns to
+# rows with headerb's columns.  corr.v[j] is the position in headera of
+# the column that maps to headerb's jth column (None if there is none),
+# and corr.n is the length of headera.  It unpacks like the (n, v)
+# tuple it used to be.
 
-# correspondence[j] is position of column that maps to jth column
 def correspondence(headera, headerb):
-  return (len(headera), [windex(headera, col) for col in headerb])
+  return Correspondence(len(headera), [windex(headera, col) for col in headerb])
 
-def precolumn(corr, j):
-  (n, v) = corr
-  return v[j]
+# The projection is compiled once, into an operator.itemgetter.  Columns
+# with no source are filled from a sentinel MISSING that is appended to
+# the row for the duration of the call, so the only list built per row
+# is the result.  project() doesn't check the length of the row; use
+# project_batch, or apply_correspondence, which do.
 
-def apply_correspondence(corr, rowa):
-  (n, v) = corr
-  if len(rowa) != n:
+class Correspondence:
+  def __init__(self, n, v):
+    self.n = n
+    self.v = v
+    positions = [n if i == None else i for i in v]
+    if not positions:
+      self.project = lambda row: []
+    elif len(positions) == 1:
+      (i,) = positions
+      if i == n:
+        self.project = lambda row: [MISSING]
+      else:
+        self.project = lambda row: [row[i]]
+    elif None in v:
+      getter = itemgetter(*positions)
+      def project(row):
+        row.append(MISSING)
+        try:
+          return list(getter(row))
+        finally:
+          row.pop()
+      self.project = project
+    else:
+      getter = itemgetter(*positions)
+      self.project = lambda row: list(getter(row))
+
+  def __call__(self, row):
+    return self.project(row)
+
+  # Projects a list of rows, checking all their lengths at once
+  def project_batch(self, rows):
+    if rows and set(map(len, rows)) != {self.n}:
+      for row in rows:
+        check_length(self, row)
+    return list(map(self.project, rows))
+
+  def __iter__(self):
+    return iter((self.n, self.v))
+
+  def __repr__(self):
+    return repr((self.n, self.v))
+
+def check_length(corr, rowa):
+  if len(rowa) != corr.n:
     print("Incorrect length input: apply %s\n to %s" % (corr, rowa,),
           file=sys.stderr)
     assert False
-  def m(j):
-    i = v[j]
-    return rowa[i] if i != None else MISSING
-  return [m(j) for j in range(0, len(v))]
+
+def precolumn(corr, j):
+  return corr.v[j]
+
+# Returns row with same length as correspondence
+def apply_correspondence(corr, rowa):
+  check_length(corr, rowa)
+  return corr.project(rowa)
 
 # test
 _corr = correspondence([1,2,3], [3,1])
 assert apply_correspondence(_corr, [10,20,30]) == [30,10]
+_corr = correspondence([1,2,3], [3,4,1])
+assert _corr.project_batch([[10,20,30]]) == [[30,MISSING,10]]
 
 def csv_parameters(path):
   if not path or ".csv" in path: